@@ -1,7 +1,10 @@
-from voronoms import load, process, plot, export
+from voronoms import load, process, plot, export, manifest, update, download, topology, cache
 from pathlib import Path
+from multiprocessing import get_context
+import numpy as np
 import argparse
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")
 
 """
 This script generates Voronoms polygons for a requested set of countries and
@@ -15,20 +18,237 @@ It accepts the following arguments:
 --countries, -c: A list of two-letter country codes for countries to plot. If none is provided, the script will iterate over all countries in the GeoNames dataset.
 --admin-levels, -a: A list of numbers specifying the admin levels to generate. If none are given, the script will attempt to generate polygons for a country's admin levels 1–3.
 --logfile, -l: The name of a file used to track which admin level/country combinations have been produced. Each line of text corresponds to one admin level and country, and is the same as the name used for the files for that combination, e.g. "US-1". The script looks for this file before it starts processing, and will skip any combinations whose label is present in this file. This can be used to resume a long-running task that's been interrupted.
---clean: The polygon-cleaning heuristic used by Voronoms, "cutoff" by default. Available options are "none", "cutoff", and "simple". These are described in more detail below.
---formats, -f: The formats to save polygons in. Any combination of "json", "txt", and "png"; all three by default.
+--manifest, -m: The name of a build manifest file, which records a digest of the inputs to each admin level/country combination that has been produced. If this is given, the script only rebuilds combinations whose inputs or parameters have changed since they were recorded. Countries whose GeoNames have no newer modification date, and whose outline and admin code tables haven't changed, are skipped without being looked at further. This can be used to refresh a release from a new GeoNames dump. When a manifest is given, it alone decides what's rebuilt, and the log file is still written but isn't used to skip combinations.
+--clean: The polygon-cleaning heuristic used by Voronoms, "cutoff" by default. Available options are "none", "cutoff", "geodesic-cutoff", and "simple". These are described in more detail below. "geodesic-cutoff" is "cutoff" with the sizes of polygons compared by their geodesic areas, rather than their areas in square degrees, which shrink toward the poles.
+--tessellation: How a country's Voronoi diagrams are drawn, "per-level" by default. With "per-level", each admin level gets a Voronoi diagram of its own points, and its polygons are the exact unions of their cells. With "shared", one diagram is drawn over the points of all of the country's requested admin levels and shared by them, and the cells of points that don't take part in a level are handed to the nearest point that does. This is faster, but it only approximates each level's own diagram, so the polygons of lower admin levels, which use fewer of the points, come out slightly different.
+--dissolve: How admin areas are merged from Voronoi cells, "flat" by default. With "flat", each admin level is merged from its own Voronoi cells, independently of the other levels. With "hierarchical", the finest requested level is merged from cells and each coarser level is merged from the polygons of its child areas, which is much faster for countries with many points. "hierarchical" always uses a shared tessellation, and so gives the same approximation as "--tessellation shared".
+--engine: How Voronoi cells are merged within an admin level, "union" by default. "union" builds a polygon for each cell and unions them; "ridges" traces each admin area's outline directly from the edges of the Voronoi diagram, which is faster. Only used with "--dissolve flat".
+--formats, -f: The formats to save polygons in. Any combination of "json", "txt", "png", "topojson", and "parquet"; the first three by default. With "topojson", each admin level/country combination is saved as a TopoJSON file, which stores each boundary shared by neighboring polygons only once, with quantized, delta-encoded coordinates; these files are several times smaller than the GeoJSON files. With "parquet", the polygons from every admin level/country combination are collected into a single GeoParquet file, "voronoms.parquet", in the export directory, with columns for the country, admin level, GeoNames ID, WKB geometry and bounding box. Each combination is stored as its own row group, so readers can filter by country, admin level or bounding box without reading the rest of the file.
+--precision, -p: The number of decimal places coordinates are written with in GeoJSON files and text files. By default, GeoJSON files have 15 decimal places, as GDAL writes them, and text files have as many as it takes to represent each coordinate exactly.
+--quantization, -q: The number of distinct values along each axis of the grid that TopoJSON coordinates are quantized to, 100000 by default. Larger values keep more detail and make larger files.
+--lod: A list of simplification tolerances, in degrees, from finest to coarsest. For each one, a level of detail is made by simplifying the polygons' shared boundaries, so that neighboring polygons still meet without gaps or overlaps, and saved alongside the full-resolution polygons in every format, with "-lod1", "-lod2" and so on added to the file names. In the GeoParquet file, the level of detail is in its own column, with 0 for the full resolution.
+--measures: If this option is present, each polygon's geodesic area in square kilometers and perimeter in kilometers, measured on the WGS84 ellipsoid, are saved with it: as "areaKm2" and "perimeterKm" properties in GeoJSON and TopoJSON files, as columns of the same names in text files, and in the "area_km2" and "perimeter_km" columns of the GeoParquet file, which are otherwise left empty.
+--gzip: If this option is present, GeoJSON, text, and TopoJSON files are gzipped, and ".gz" is added to their names.
 --dir, -d: Where to save generated files. By default, a folder named "export" is created in the directory from which the script is run.
---combine-format-folders: If this option is present, the GeoJSON, tab-delimited text, and PNG files will be saved in the top level of the export directory. Otherwise, they'll be saved in separate subfolders named "json", "txt", and "png".
+--workers, -w: The number of countries to process in parallel, 1 by default. Workers are forked from the main process once the GeoNames data is loaded, so they share it rather than loading their own copies. The log file is only written to by the main process, as each country finishes.
+--compact: If this option is present, GeoNames are loaded in compact mode: low-cardinality text columns are stored as categoricals, and each admin area is identified by a single integer key for its full admin path, such as "US.NY.047", rather than by its separate admin codes. This uses less memory and makes grouping points by admin area faster, but it changes which points go into the Voronoi diagrams. Without it, a point takes part in an admin level if each of its admin codes belongs to some admin area of the level, even if no one area has all of them, as with a county code that only exists under a different state. In compact mode, a point only takes part if its full admin path is an admin area's, so points whose codes mix different parents are left out, and polygons can come out slightly different. "--shards" always uses compact mode.
+--shards: If this option is present, GeoNames are read from per-country shards of memory-mapped NumPy files in the cache directory, which are written from allCountries.txt the first time, and again whenever it changes. Opening a country's shard is nearly instant, so this suits runs over a few countries, and workers share the shards' pages.
+--update: If this option is present, GeoNames's daily modifications and deletes files are downloaded for every day since the allCountries.txt dump the cached GeoNames table was built from, or since it was last updated, and applied to it all at once, instead of re-reading allCountries.txt. The countries they change are marked dirty, so that a build manifest rebuilds them, and their shards are rewritten.
+--revalidate: If this option is present, GeoNames files that have already been downloaded are checked against geonames.org, and downloaded again if they've changed. Only their headers are fetched if they haven't.
+--png-workers: The number of processes that render PNG plots, 0 by default. If this is more than 0, tasks hand their polygons to a pool of rendering processes and carry on, rather than waiting for their plots to be drawn. Each plot is drawn as a single collection of paths with the Agg backend.
+--threads, -t: The number of threads used to merge the admin areas within a single country, 1 by default. This helps most with the few very large countries that otherwise hold up a run.
+--combine-format-folders: If this option is present, the GeoJSON, tab-delimited text, PNG, and TopoJSON files will be saved in the top level of the export directory. Otherwise, they'll be saved in separate subfolders named "json", "txt", "png", and "topojson".
 """
 
+# The data each task needs. These are set in the main process before any workers
+# are started, so forked workers share them instead of receiving pickled copies.
+GEONAMES = None
+SHAPES = None
+
+
+def make_country(country, admin_levels, options, previous_digests=None):
+    """
+    Generates and saves the polygons for a country's admin levels.
+
+    If `previous_digests` is given, the inputs to each admin level are digested
+    first, and levels whose digest matches their previous one are skipped.
+
+    Returns the country, the names of the tasks that were attempted, the digests
+    of the tasks that were built successfully, their GeoParquet tables, and the
+    PNG plots left for the main process to render.
+    """
+    digests = {}
+    build_levels = admin_levels
+    if previous_digests is not None:
+        try:
+            digests = task_digests(country, admin_levels, options["params"])
+        except Exception:
+            # Any problem with the inputs will be reported when building.
+            pass
+        build_levels = []
+        for admin_level in admin_levels:
+            task_name = "{}-{}".format(country, admin_level)
+            if task_name in digests and digests[task_name] == previous_digests.get(task_name):
+                print("Inputs for {} are unchanged; skipping.".format(task_name))
+            else:
+                build_levels.append(admin_level)
+
+    # With a shared tessellation, the country's Voronoi diagram is drawn once for
+    # all of its admin levels. Otherwise each level draws its own, exactly.
+    shared = uses_shared_tessellation(options["params"])
+    tessellation = None
+    hierarchical_polygons = {}
+    attempted = []
+    built = {}
+    geoparquet_tables = []
+    png_jobs = []
+    for admin_level in build_levels:
+        task_name = "{}-{}".format(country, admin_level)
+        print("Working on {}.".format(task_name))
+        try:
+            if shared:
+                if tessellation is None:
+                    tessellation = process.Tessellation(country, GEONAMES, SHAPES, admin_levels)
+                admin_geonames = tessellation.admin_geonames[admin_level]
+            else:
+                admin_geonames = process.get_admin_geonames(
+                    country, admin_level, process.get_country_geonames(country, GEONAMES)
+                )
+            if options["dissolve"] == "hierarchical" and not hierarchical_polygons:
+                hierarchical_polygons.update(
+                    process.make_hierarchical_admin_polygons(
+                        tessellation, clean=options["clean"], workers=options["threads"]
+                    )
+                )
+            if admin_level in hierarchical_polygons:
+                admin_polygons = hierarchical_polygons[admin_level]
+            else:
+                admin_polygons = process.make_admin_polygons(
+                    country, admin_level, GEONAMES, SHAPES, clean=options["clean"],
+                    tessellation=tessellation, engine=options["engine"], workers=options["threads"],
+                )
+            if options["lod"]:
+                admin_polygons = topology.simplification_pyramid(admin_polygons, options["lod"])
+        except Exception as e:
+            print("Error: Could not generate polygons for '{}'. Reason: {}.".format(task_name, e))
+        else:
+            task_tables, task_png_jobs = save_task(task_name, admin_geonames, admin_polygons, options)
+            geoparquet_tables.extend(task_tables)
+            png_jobs.extend(task_png_jobs)
+            print("Created files for {}.".format(task_name))
+            if task_name in digests:
+                built[task_name] = digests[task_name]
+        attempted.append(task_name)
+    return country, attempted, built, geoparquet_tables, png_jobs
+
+
+def make_country_star(args):
+    return make_country(*args)
+
+
+def uses_shared_tessellation(params):
+    # Hierarchical dissolves merge cells of the shared tessellation, so they always
+    # need one.
+    return params["tessellation"] == "shared" or params["dissolve"] == "hierarchical"
+
+
+def task_digests(country, admin_levels, params):
+    """
+    Digests the inputs to each of a country's admin levels, keyed by task name.
+    """
+    country_geonames = process.get_country_geonames(country, GEONAMES)
+    outline = process.get_country_outline(country, country_geonames, SHAPES)
+    admin_geonames = {}
+    voronoi_geonames = {}
+    for admin_level in admin_levels:
+        admin_geonames[admin_level] = process.get_admin_geonames(country, admin_level, country_geonames)
+        voronoi_geonames[admin_level] = process.get_voronoi_geonames(
+            country, admin_level, country_geonames, admin_geonames[admin_level]
+        )
+    # With a shared tessellation, every level's points go into each level's cells.
+    if uses_shared_tessellation(params):
+        shared_geonameids = np.unique(
+            np.concatenate([v.index.to_numpy() for v in voronoi_geonames.values()])
+        )
+        context_geonameids = {admin_level: shared_geonameids for admin_level in admin_levels}
+    else:
+        context_geonameids = {
+            admin_level: voronoi_geonames[admin_level].index.to_numpy() for admin_level in admin_levels
+        }
+    return {
+        "{}-{}".format(country, admin_level): manifest.task_digest(
+            admin_geonames[admin_level], voronoi_geonames[admin_level], context_geonameids[admin_level],
+            outline, params,
+        )
+        for admin_level in admin_levels
+    }
+
+
+def save_task(task_name, admin_geonames, admin_polygons, options):
+    """
+    Saves a task's polygons, and each of their levels of detail if they're a
+    simplification pyramid, in the requested formats. GeoParquet rows aren't
+    written here, but returned as tables for the main process to write, along
+    with the PNG plots left for a rendering pool, if there is one.
+    """
+    levels = sorted(admin_polygons) if isinstance(admin_polygons, dict) else [0]
+    geoparquet_tables = []
+    png_jobs = []
+    for lod in levels:
+        file_name = task_name if lod == 0 else "{}-lod{}".format(task_name, lod)
+        table, png_job = save_level(task_name, file_name, admin_geonames, admin_polygons, lod, options)
+        if table is not None:
+            geoparquet_tables.append(table)
+        if png_job is not None:
+            png_jobs.append(png_job)
+    return geoparquet_tables, png_jobs
+
+
+def save_level(task_name, file_name, admin_geonames, admin_polygons, lod, options):
+    formats = options["formats"]
+    suffix = ".gz" if options["gzip"] else ""
+    if "json" in formats:
+        json_filename = Path(options["json_dir"], "{}.json{}".format(file_name, suffix))
+        export.geonames_json(
+            admin_geonames, admin_polygons, json_filename, options["precision"], options["gzip"], lod,
+            options["measures"],
+        )
+    if "txt" in formats:
+        txt_filename = Path(options["txt_dir"], "{}.txt{}".format(file_name, suffix))
+        export.geonames_table(
+            admin_geonames, admin_polygons, txt_filename, options["precision"], options["gzip"], lod,
+            options["measures"],
+        )
+    if "topojson" in formats:
+        topojson_filename = Path(options["topojson_dir"], "{}.topojson{}".format(file_name, suffix))
+        export.geonames_topojson(
+            admin_geonames, admin_polygons, topojson_filename, options["quantization"], options["gzip"], lod,
+            options["measures"],
+        )
+    geoparquet = None
+    if "parquet" in formats:
+        country, admin_level = task_name.rsplit("-", 1)
+        geoparquet = export.geoparquet_table(
+            country, int(admin_level), admin_geonames, admin_polygons, lod, options["measures"]
+        )
+    png_job = None
+    if "png" in formats:
+        png_filename = Path(options["png_dir"], "{}.png".format(file_name))
+        png_job = (topology.select_lod(admin_polygons, lod), png_filename)
+        if not options["png_workers"]:
+            render_png(*png_job)
+            png_job = None
+    return geoparquet, png_job
+
+
+def render_png(admin_polygons, png_filename):
+    plot.save_polygons(admin_polygons, png_filename)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--countries", "-c", type=str, nargs="*")
     parser.add_argument("--admin-levels", "-a", type=int, nargs="*")
     parser.add_argument("--logfile", "-l", type=str, default="log.txt")
+    parser.add_argument("--manifest", "-m", type=str)
     parser.add_argument("--clean", type=str, default="cutoff")
-    parser.add_argument("--formats", "-f", nargs="*", choices=["json", "txt", "png"], default=["json", "txt", "png"])
+    parser.add_argument("--tessellation", type=str, choices=["per-level", "shared"], default="per-level")
+    parser.add_argument("--dissolve", type=str, choices=["flat", "hierarchical"], default="flat")
+    parser.add_argument("--engine", type=str, choices=["union", "ridges"], default="union")
+    parser.add_argument("--formats", "-f", nargs="*", choices=["json", "txt", "png", "topojson", "parquet"], default=["json", "txt", "png"])
+    parser.add_argument("--precision", "-p", type=int)
+    parser.add_argument("--quantization", "-q", type=int, default=export.DEFAULT_QUANTIZATION)
+    parser.add_argument("--lod", type=float, nargs="*")
+    parser.add_argument("--measures", action="store_true")
+    parser.add_argument("--gzip", action="store_true")
     parser.add_argument("--dir", "-d", nargs="?", default="export")
+    parser.add_argument("--workers", "-w", type=int, default=1)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--shards", action="store_true")
+    parser.add_argument("--update", action="store_true")
+    parser.add_argument("--revalidate", action="store_true")
+    parser.add_argument("--png-workers", type=int, default=0)
+    parser.add_argument("--threads", "-t", type=int, default=1)
     parser.add_argument("--combine-format-folders", action="store_true")
     args = parser.parse_args()
 
@@ -37,13 +257,14 @@ if __name__ == "__main__":
 
     # Sort out output directories
     if args.combine_format_folders or len(formats) == 1:
-        json_dir = txt_dir = fig_dir = export_dir
+        json_dir = txt_dir = png_dir = topojson_dir = export_dir
         if not export_dir.exists():
             export_dir.mkdir(parents=True)
     else:
         json_dir = Path(export_dir, "json")
         txt_dir = Path(export_dir, "txt")
         png_dir = Path(export_dir, "png")
+        topojson_dir = Path(export_dir, "topojson")
         if "json" in formats:
             if not json_dir.exists():
                 json_dir.mkdir(parents=True)
@@ -53,55 +274,210 @@ if __name__ == "__main__":
         if "png" in formats:
             if not png_dir.exists():
                 png_dir.mkdir(parents=True)
+        if "topojson" in formats:
+            if not topojson_dir.exists():
+                topojson_dir.mkdir(parents=True)
+
+    options = {
+        "formats": formats,
+        "json_dir": json_dir,
+        "txt_dir": txt_dir,
+        "png_dir": png_dir,
+        "topojson_dir": topojson_dir,
+        "clean": args.clean,
+        "dissolve": args.dissolve,
+        "engine": args.engine,
+        "threads": args.threads,
+        "png_workers": args.png_workers,
+        "precision": args.precision,
+        "quantization": args.quantization,
+        "lod": args.lod,
+        "measures": args.measures,
+        "gzip": args.gzip,
+        "params": {
+            "clean": args.clean,
+            "tessellation": args.tessellation,
+            "dissolve": args.dissolve,
+            "engine": args.engine,
+        },
+    }
+    # Compact mode, levels of detail and measures change what's saved for a task,
+    # so they're part of its parameters when they're used. Without them, digests
+    # stay as they were. Shards hold admin keys, so they're always compact.
+    compact = args.compact or args.shards
+    if compact:
+        options["params"]["compact"] = True
+    if args.lod:
+        options["params"]["lod"] = args.lod
+    if args.measures:
+        options["params"]["measures"] = True
 
-    # Get the list of tasks in this log file.
+    # Get the list of tasks in this log file. With a manifest, the manifest decides
+    # what's rebuilt, so tasks that were logged but have changed aren't skipped.
+    logged_tasks = []
     if args.logfile:
         logfile = Path(export_dir, args.logfile)
-        if logfile.exists():
+        if logfile.exists() and not args.manifest:
             with open(logfile) as f:
                 logged_tasks = f.read().splitlines() 
-        else:
-            logged_tasks = []
 
-    # Load the data now.
-    geonames = load.geonames()
-    shapes = load.shapes()
+    # Fetch the GeoNames files the run needs concurrently, before loading any of them.
+    download.geonames_files(
+        ["allCountries.txt", "admin1CodesASCII.txt", "admin2Codes.txt", "shapes_all_low.txt"],
+        revalidate=args.revalidate,
+    )
+
+    # Load the data now. Only the columns and countries we need are read, and the
+    # GeoNames are split by country up front, so that each task only ever looks
+    # at its own country's rows.
+    if args.shards:
+        geonames_kwargs = {"columns": load.PROCESSING_COLUMNS, "compact": True}
+    else:
+        geonames_kwargs = {"columns": load.PROCESSING_COLUMNS, "countries": args.countries, "compact": compact}
+    geonames = None
+    touched = set()
+    if args.update:
+        print("Applying GeoNames daily deltas.")
+        geonames, touched = update.update_geonames(**geonames_kwargs)
+    if args.shards:
+        if not load.shards_current():
+            print("Writing per-country GeoNames shards.")
+            if geonames is None:
+                geonames = load.geonames(**geonames_kwargs)
+            load.write_shards(load.geonames_by_country(geonames), replace=True)
+        elif touched:
+            print("Rewriting GeoNames shards for updated countries.")
+            partition = load.geonames_by_country(geonames)
+            load.write_shards({country: partition[country] for country in touched if country in partition})
+        GEONAMES = load.GeonamesShards()
+    else:
+        if geonames is None:
+            geonames = load.geonames(**geonames_kwargs)
+        GEONAMES = load.geonames_by_country(geonames)
+    del geonames
+    SHAPES = load.shapes()
+
+    # Get the record of what earlier runs were built from, and of the countries
+    # that GeoNames deltas have changed since the table was built.
+    if args.manifest:
+        manifest_path = Path(export_dir, args.manifest)
+        build_manifest = manifest.read_manifest(manifest_path)
+        params_digest = manifest.params_digest(options["params"])
+        dirty = update.dirty_countries(**geonames_kwargs)
+        # The admin code tables number compact admin keys, so they're part of
+        # every country's fingerprint, along with its outline.
+        source_signatures = [
+            cache.source_signature(download.geonames_file(name))
+            for name in ["admin1CodesASCII.txt", "admin2Codes.txt"]
+        ]
 
     # If these arguments aren't present, we will go through ALL of the countries
-    countries = args.countries if args.countries else geonames.country_code.dropna().unique()
+    countries = args.countries if args.countries else list(GEONAMES.keys())
     admin_levels = args.admin_levels if args.admin_levels else [1, 2, 3]
-    to_process = [(country, admin) for country in countries for admin in admin_levels]
 
+    # Tasks are grouped by country, so that a country's levels can share its tessellation.
+    to_process = []
+    fingerprints = {}
+    for country in countries:
+        country_levels = []
+        for admin_level in admin_levels:
+            task_name = "{}-{}".format(country, admin_level)
+            if task_name in logged_tasks:
+                print(f"Found {task_name} in previously logged tasks; skipping.")
+            else:
+                country_levels.append(admin_level)
+        if not country_levels:
+            continue
+        if not args.manifest:
+            to_process.append((country, country_levels, options))
+            continue
 
-    for country, admin_level in to_process:
-        task_name = "{}-{}".format(country, admin_level)
-        if task_name in logged_tasks:
-            print(f"Found {task_name} in previously logged tasks; skipping.")
+        # A country whose GeoNames, outline and admin code tables haven't changed
+        # since its last build, and whose levels were all built with the same
+        # parameters, is skipped outright.
+        # Otherwise each level's inputs are digested to find the ones that changed.
+        if country in GEONAMES:
+            try:
+                outline = process.get_country_outline(country, GEONAMES[country], SHAPES)
+            except Exception:
+                outline = None
+            fingerprints[country] = manifest.country_fingerprint(
+                GEONAMES[country], outline, source_signatures, dirty.get(country)
+            )
+        previous_tasks = {
+            "{}-{}".format(country, a): build_manifest["tasks"].get("{}-{}".format(country, a))
+            for a in country_levels
+        }
+        unchanged = (
+            country in fingerprints
+            and build_manifest["countries"].get(country) == fingerprints[country]
+            and all(t is not None and t["params"] == params_digest for t in previous_tasks.values())
+        )
+        if unchanged:
+            print(f"GeoNames for {country} are unchanged since the last build; skipping.")
             continue
-        print("Working on {}.".format(task_name))
+        previous_digests = {
+            task_name: task["digest"] for task_name, task in previous_tasks.items() if task is not None
+        }
+        to_process.append((country, country_levels, options, previous_digests))
 
-        admin_geonames = process.get_admin_geonames(country, admin_level, geonames)
-        # if len(admin_geonames) == 0:
-        #     print("No admin geonames for task '{}'.".format(task_name))
-        #     continue
-        # else:
-        try:
-            admin_polygons = process.make_admin_polygons(country, admin_level, geonames, shapes, clean="cutoff")
-        except Exception as e:
-            print("Error: Could not generate polygons for '{}'. Reason: {}.".format(task_name, e))
-        else:
-            if "json" in formats:
-                json_filename = Path(json_dir, "{}.json".format(task_name))
-                export.geonames_json(admin_geonames, admin_polygons, json_filename)
-            if "txt" in formats:
-                txt_filename = Path(txt_dir, "{}.txt".format(task_name))
-                export.geonames_table(admin_geonames, admin_polygons, txt_filename)
-            if "png" in formats:
-                png_filename = Path(png_dir, "{}.png".format(task_name))
-                plot.polygons(admin_polygons).savefig(png_filename)
-                plt.close("all")
-            print("Created files for {}.".format(task_name))
-        finally:
+    if args.workers > 1:
+        pool = get_context("fork").Pool(args.workers)
+        results = pool.imap_unordered(make_country_star, to_process)
+    else:
+        pool = None
+        results = map(make_country_star, to_process)
+
+    # GeoParquet rows from every task go into one file, written by this process.
+    geoparquet_writer = None
+    if "parquet" in formats:
+        geoparquet_writer = export.GeoParquetWriter(Path(export_dir, "voronoms.parquet"))
+
+    # PNG plots can be rendered by a pool of their own while tasks carry on. A
+    # country is only logged once its plots are saved, so that an interrupted run
+    # doesn't skip countries whose plots are missing.
+    render_pool = None
+    if "png" in formats and args.png_workers > 0:
+        render_pool = get_context("fork").Pool(args.png_workers)
+    pending = []
+
+    def record_finished(wait=False):
+        while pending:
+            country, attempted, built, renders = pending[0]
+            if not wait and not all(render.ready() for render in renders):
+                break
+            for render in renders:
+                try:
+                    render.get()
+                except Exception as e:
+                    print("Error: Could not render a plot for {}. Reason: {}.".format(country, e))
+            pending.pop(0)
             if args.logfile:
                 with open(logfile, "a+") as f:
-                    f.write(f"{task_name}\n")
+                    for task_name in attempted:
+                        f.write(f"{task_name}\n")
+            if args.manifest:
+                for task_name, digest in built.items():
+                    build_manifest["tasks"][task_name] = {"digest": digest, "params": params_digest}
+                if country in fingerprints:
+                    build_manifest["countries"][country] = fingerprints[country]
+                manifest.write_manifest(build_manifest, manifest_path)
+
+    try:
+        for country, attempted, built, geoparquet_tables, png_jobs in results:
+            if geoparquet_writer is not None:
+                for table in geoparquet_tables:
+                    geoparquet_writer.write_task(table)
+            renders = [render_pool.apply_async(render_png, job) for job in png_jobs]
+            pending.append((country, attempted, built, renders))
+            record_finished()
+        if render_pool is not None:
+            render_pool.close()
+        record_finished(wait=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if render_pool is not None:
+            render_pool.terminate()
+        if geoparquet_writer is not None:
+            geoparquet_writer.close()
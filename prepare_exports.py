@@ -13,11 +13,11 @@ mtime = os.path.getmtime(geonames_file("allCountries.txt"))
 mdate = date.fromtimestamp(mtime).isoformat()
 ddate = date.fromtimestamp(mtime).strftime("%Y.%m.%d")
 
-for fmt in ["json", "txt", "png"]:
+for fmt in ["json", "txt", "png", "topojson"]:
     fmt_dir = Path(EXPORT_DIR, fmt)
     if not fmt_dir.exists():
         continue
-    files = [f for f in fmt_dir.iterdir() if f.suffix == f".{fmt}"]
+    files = [f for f in fmt_dir.iterdir() if f.name.endswith((f".{fmt}", f".{fmt}.gz"))]
 
 
 
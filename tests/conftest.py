@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from voronoms import cache, download, update
+
+
+class GeoNamesHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files in `server.files` the way download.geonames.org does, with
+    ETags, conditional GETs and byte ranges, and records each request.
+    """
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        self.server.requests.append((name, dict(self.headers)))
+        if name not in self.server.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.files[name]
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") in (None, etag):
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(body)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status, body = 206, body[start:]
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.server.last_modified)
+        self.send_header("Content-Type", "application/zip" if name.endswith(".zip") else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def geonames_server(tmp_path, monkeypatch):
+    """
+    Points `voronoms.download` at a local HTTP server, and the data and cache
+    directories at a temporary directory. Files are served from the server's
+    `files` dictionary, keyed by name.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GeoNamesHandler)
+    server.files = {}
+    server.requests = []
+    server.last_modified = "Mon, 01 Jan 2024 00:00:00 GMT"
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+
+    geonames_dir = tmp_path / "GeoNames"
+    cache_dir = tmp_path / "cache"
+    geonames_dir.mkdir()
+    cache_dir.mkdir()
+    monkeypatch.setattr(download, "GEONAMES_URL", "http://127.0.0.1:{}/".format(server.server_port))
+    monkeypatch.setattr(download, "GEONAMES_DIR", geonames_dir)
+    monkeypatch.setattr(cache, "CACHE_DIR", cache_dir)
+    monkeypatch.setattr(update, "DELTA_RECORD_PATH", cache_dir / "geonames_deltas.json")
+    yield server
+    server.shutdown()
+    server.server_close()
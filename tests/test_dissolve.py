@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import shapely
+from scipy.spatial import Voronoi
+from voronoms import dissolve, process
+
+OUTLINE = shapely.Point(0, 0).buffer(9)
+
+
+def ringed_country(seed, n=1500):
+    """
+    Scatters points over a disk and labels them by distance from its center, so
+    the middle area is a ring around the inner one. A few points are in no area,
+    which punches holes in the areas around them.
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(-10, 10, size=(n, 2))
+    radii = np.hypot(points[:, 0], points[:, 1])
+    labels = np.digitize(radii, [3, 6])
+    labels[rng.random(n) < 0.03] = -1
+    return Voronoi(points), labels
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_ridges_match_union(seed):
+    voronoi, labels = ringed_country(seed)
+    ridges = process.dissolve_and_clip(voronoi, labels, 3, OUTLINE)
+    union = [
+        process.extract_polygon_from_voronoi(np.flatnonzero(labels == label), voronoi, OUTLINE)
+        for label in range(3)
+    ]
+
+    for ridges_polygon, union_polygon in zip(ridges, union):
+        assert ridges_polygon.is_valid
+        assert ridges_polygon.area == pytest.approx(union_polygon.area, rel=1e-9)
+        assert ridges_polygon.symmetric_difference(union_polygon).area < 1e-9 * union_polygon.area
+        assert len(ridges_polygon.geoms) == len(union_polygon.geoms)
+        assert sum(len(part.interiors) for part in ridges_polygon.geoms) == sum(
+            len(part.interiors) for part in union_polygon.geoms
+        )
+    # The ring's hole is where the inner area is.
+    ring_holes = [shapely.Polygon(hole) for part in ridges[1].geoms for hole in part.interiors]
+    assert any(hole.contains(ridges[0].representative_point()) for hole in ring_holes)
+
+
+def test_stitch_rings_splits_touching_squares():
+    # Two squares that share only the corner at vertex 2.
+    vertices = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [2, 1], [2, 2], [1, 2]], dtype=float)
+    edges = [(0, 1), (1, 2), (2, 3), (3, 0), (2, 4), (4, 5), (5, 6), (6, 2)]
+    rings = dissolve.stitch_rings(edges, vertices)
+    multipolygon = dissolve.rings_to_multipolygon(rings, vertices)
+    assert sorted(len(ring) for ring in rings) == [4, 4]
+    assert multipolygon.is_valid
+    assert multipolygon.area == pytest.approx(2)
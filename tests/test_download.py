@@ -0,0 +1,94 @@
+import io
+import json
+import os
+from zipfile import ZipFile
+import pytest
+from voronoms import download
+
+CONTENT = bytes(range(256)) * 64
+
+
+def write_part(name, data, etag):
+    part_path = download.GEONAMES_DIR / (name + ".part")
+    part_path.write_bytes(data)
+    with open(part_path.with_name(part_path.name + ".json"), "w") as f:
+        json.dump({"etag": etag, "last_modified": None}, f)
+
+
+def test_resumes_partial_download(geonames_server):
+    geonames_server.files["hierarchy.txt"] = CONTENT
+    download.geonames_file("hierarchy.txt")
+    etag = download.read_validators("hierarchy.txt")["etag"]
+    (download.GEONAMES_DIR / "hierarchy.txt").unlink()
+    write_part("hierarchy.txt", CONTENT[:1000], etag)
+
+    path = download.geonames_file("hierarchy.txt")
+
+    assert path.read_bytes() == CONTENT
+    headers = geonames_server.requests[-1][1]
+    assert headers["Range"] == "bytes=1000-"
+    assert headers["If-Range"] == etag
+    assert sorted(os.listdir(download.GEONAMES_DIR)) == [".hierarchy.txt.json", "hierarchy.txt"]
+
+
+@pytest.mark.parametrize("part, etag, requests", [
+    # The file has changed on the server, so the server ignores the range.
+    (b"stale", '"0000000000000000"', 1),
+    # The part is longer than the file, so the server answers 416 and the
+    # download starts over.
+    (CONTENT + b"stale", None, 2),
+])
+def test_restarts_unresumable_download(geonames_server, part, etag, requests):
+    geonames_server.files["hierarchy.txt"] = CONTENT
+    if etag is None:
+        download.geonames_file("hierarchy.txt")
+        etag = download.read_validators("hierarchy.txt")["etag"]
+        (download.GEONAMES_DIR / "hierarchy.txt").unlink()
+    write_part("hierarchy.txt", part, etag)
+    previous_requests = len(geonames_server.requests)
+
+    path = download.geonames_file("hierarchy.txt")
+
+    assert path.read_bytes() == CONTENT
+    assert not (download.GEONAMES_DIR / "hierarchy.txt.part").exists()
+    assert len(geonames_server.requests) - previous_requests == requests
+    assert geonames_server.requests[previous_requests][1]["If-Range"] == etag
+
+
+def test_revalidation_keeps_unchanged_file(geonames_server):
+    geonames_server.files["hierarchy.txt"] = CONTENT
+    path = download.geonames_file("hierarchy.txt")
+    os.utime(path, (0, 0))
+
+    assert download.geonames_file("hierarchy.txt", revalidate=True) == path
+    assert geonames_server.requests[-1][1]["If-None-Match"] == download.read_validators("hierarchy.txt")["etag"]
+    assert path.stat().st_mtime == 0
+
+    geonames_server.files["hierarchy.txt"] = CONTENT[::-1]
+    download.geonames_file("hierarchy.txt", revalidate=True)
+    assert path.read_bytes() == CONTENT[::-1]
+
+
+def test_falls_back_to_zip(geonames_server):
+    archive = io.BytesIO()
+    with ZipFile(archive, "w") as z:
+        z.writestr("allCountries.txt", CONTENT)
+    geonames_server.files["allCountries.zip"] = archive.getvalue()
+    geonames_server.files["admin2Codes.txt"] = CONTENT[::-1]
+
+    paths = download.geonames_files(["allCountries.txt", "admin2Codes.txt"])
+
+    assert paths == [download.GEONAMES_DIR / "allCountries.txt", download.GEONAMES_DIR / "admin2Codes.txt"]
+    assert paths[0].read_bytes() == CONTENT
+    assert paths[1].read_bytes() == CONTENT[::-1]
+    assert not (download.GEONAMES_DIR / "allCountries.zip").exists()
+    assert download.read_validators("allCountries.txt")["download_name"] == "allCountries.zip"
+
+
+def test_missing_file_raises(geonames_server):
+    with pytest.raises(FileNotFoundError):
+        download.geonames_file("modifications-2024-01-01.txt")
+    assert [name for name, _ in geonames_server.requests] == [
+        "modifications-2024-01-01.txt",
+        "modifications-2024-01-01.zip",
+    ]
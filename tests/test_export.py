@@ -0,0 +1,23 @@
+import pandas as pd
+import shapely
+from voronoms import export
+
+
+def test_empty_geometries_match_gdal(tmp_path):
+    # Cleaning can leave an admin area with an empty MultiPolygon, which GDAL
+    # writes with a spaced empty array.
+    polygons = [shapely.MultiPolygon(), shapely.box(0, 0, 1, 1), shapely.Polygon()]
+    filename = tmp_path / "XX-3.json"
+    export.geonames_json(pd.DataFrame(index=[1, 2, 3]), polygons, filename)
+    assert filename.read_text() == (
+        '{\n"type": "FeatureCollection",\n"name": "XX-3",\n"features": [\n'
+        '{ "type": "Feature", "properties": { "geoNameId": 1 }, '
+        '"geometry": { "type": "MultiPolygon", "coordinates": [ ] } },\n'
+        '{ "type": "Feature", "properties": { "geoNameId": 2 }, '
+        '"geometry": { "type": "Polygon", "coordinates": '
+        '[ [ [ 1.0, 0.0 ], [ 1.0, 1.0 ], [ 0.0, 1.0 ], [ 0.0, 0.0 ], [ 1.0, 0.0 ] ] ] } },\n'
+        '{ "type": "Feature", "properties": { "geoNameId": 3 }, '
+        '"geometry": { "type": "Polygon", "coordinates": [ ] } }\n'
+        ']\n}\n'
+    )
+    assert '"coordinates": []' in export.geometry_json([shapely.Polygon()], None, export.JSON_STYLE)[0]
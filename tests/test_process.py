@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from scipy.spatial import Voronoi
+from voronoms import load, process
+
+OUTLINE = shapely.box(-1, -1, 31, 11)
+
+
+def synthetic_country(seed=0, n=600):
+    """
+    Scatters GeoNames over three admin1 areas side by side, each split into two
+    admin2 areas. Some points lack their admin2 code, a few lack every code, and
+    the third admin1 GeoName carries an admin2 code of its own.
+    """
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform([0, 0], [30, 10], size=(n, 2)).T
+    admin1 = np.array(["01", "02", "03"], dtype=object)[(x // 10).astype(int)]
+    admin2 = np.where(y < 5, "A", "B").astype(object)
+    admin2[rng.random(n) < 0.1] = None
+    admin1[rng.random(n) < 0.03] = None
+    places = pd.DataFrame({
+        "longitude": x,
+        "latitude": y,
+        "feature_class": "P",
+        "feature_code": "PPL",
+        "admin1_code": admin1,
+        "admin2_code": admin2,
+    })
+    admins = pd.DataFrame([
+        (5.0, 5.2, "ADM1", "01", None),
+        (15.0, 5.2, "ADM1", "02", None),
+        (25.0, 5.2, "ADM1", "03", "A"),
+        (1.0, 5.2, "ADM1", None, None),
+        (5.0, 2.2, "ADM2", "01", "A"),
+        (5.0, 7.2, "ADM2", "01", "B"),
+        (15.0, 2.2, "ADM2", "02", "A"),
+        (25.0, 7.2, "ADM2", "03", "B"),
+        (20.0, 7.2, "ADM2", "02", None),
+    ], columns=["longitude", "latitude", "feature_code", "admin1_code", "admin2_code"])
+    admins["feature_class"] = "A"
+    geonames = pd.concat([places, admins], ignore_index=True)
+    geonames.index = pd.RangeIndex(1, len(geonames) + 1, name="geonameid")
+    geonames["country_code"] = "XX"
+    geonames["admin3_code"] = None
+    geonames["admin4_code"] = None
+    geonames[["admin1_code", "admin2_code", "admin3_code", "admin4_code"]] = geonames[
+        ["admin1_code", "admin2_code", "admin3_code", "admin4_code"]
+    ].astype(object)
+    return geonames
+
+
+def filtered_point_indices(admin_geoname, geonames, voronoi_geonames):
+    # Each admin area's points, found by filtering the country's GeoNames on every
+    # admin code the admin GeoName has.
+    matches = geonames.country_code == admin_geoname.country_code
+    for col in ["admin{}_code".format(level) for level in load.ADMIN_LEVELS]:
+        if not pd.isnull(admin_geoname[col]):
+            matches &= geonames[col] == admin_geoname[col]
+    return np.flatnonzero(voronoi_geonames.index.isin(geonames.index[matches.to_numpy()]))
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("admin_level", [1, 2])
+def test_grouped_index_matches_filter(monkeypatch, compact, admin_level):
+    geonames = synthetic_country()
+    if compact:
+        code_tables = pd.DataFrame({"concatenated_codes": ["XX.02", "XX.01", "XX.02.A"]})
+        monkeypatch.setattr(load, "admin1_codes", lambda: code_tables)
+        monkeypatch.setattr(load, "admin2_codes", lambda: code_tables)
+        geonames = load.prepare_geonames(geonames, compact=True)
+
+    admin_geonames = process.get_admin_geonames("XX", admin_level, geonames)
+    voronoi_geonames = process.get_voronoi_geonames("XX", admin_level, geonames, admin_geonames)
+    voronoi = Voronoi(process.get_coordinates(voronoi_geonames))
+    point_index = process.index_voronoi_points(admin_level, voronoi_geonames)
+
+    assert len(admin_geonames) == {1: 3, 2: 4}[admin_level]
+    for _, admin_geoname in admin_geonames.iterrows():
+        point_indices = process.get_admin_point_indices(
+            admin_geoname, admin_level, point_index, voronoi_geonames
+        )
+        expected = filtered_point_indices(admin_geoname, geonames, voronoi_geonames)
+        np.testing.assert_array_equal(np.sort(point_indices), expected)
+        assert len(expected) > 0
+        polygon = process.extract_polygon_from_voronoi(point_indices, voronoi, OUTLINE)
+        expected_polygon = process.extract_polygon_from_voronoi(expected, voronoi, OUTLINE)
+        assert polygon.equals(expected_polygon)
+
+
+def brute_force_clean_simple(admin_polygons):
+    filled = process.fill_holes(admin_polygons)
+    cleaned = []
+    for this_area in filled:
+        other_polys = [poly for other_area in filled if other_area is not this_area for poly in other_area.geoms]
+        cleaned.append(shapely.MultiPolygon([
+            poly for poly in this_area.geoms
+            if not any(poly.within(other_poly) for other_poly in other_polys)
+        ]))
+    return cleaned
+
+
+def brute_force_clean_max_diff_cutoff(admin_polygons):
+    separated = [process.separate_deletion_candidates(p) for p in process.fill_holes(admin_polygons)]
+    must_keep = [list(x[0]) for x in separated]
+    can_delete = [list(x[1]) for x in separated]
+
+    cleaned = []
+    for this_area in must_keep:
+        other_polys = [poly for other_area in must_keep if other_area is not this_area for poly in other_area]
+        new_area = []
+        for a in this_area:
+            for b in other_polys:
+                if a.contains(b):
+                    a = a.difference(b)
+            new_area.append(a)
+        cleaned.append(new_area)
+
+    # The first pass compares against `other_polys` as the loop above left it:
+    # the unmodified must-keep parts of every area but the last.
+    first_pass_kept = [
+        [poly for poly in this_area if not any(poly.within(other_poly) for other_poly in other_polys)]
+        for this_area in can_delete
+    ]
+    for i, this_area in enumerate(first_pass_kept):
+        other_polys = [poly for other_area in first_pass_kept if other_area is not this_area for poly in other_area]
+        cleaned[i].extend(
+            poly for poly in this_area if not any(poly.within(other_poly) for other_poly in other_polys)
+        )
+    return [shapely.MultiPolygon(area) for area in cleaned]
+
+
+def fragmented_country():
+    big_with_hole = shapely.box(0, 0, 10, 10).difference(shapely.box(4, 4, 6, 6))
+    return [
+        # Has a hole, and a fragment inside the last area's main part.
+        shapely.MultiPolygon([big_with_hole, shapely.box(20, 20, 21, 21), shapely.box(52, 2, 53, 3)]),
+        # Has fragments inside the first area and inside the last area's fragment.
+        shapely.MultiPolygon([shapely.box(10, 0, 20, 10), shapely.box(2, 2, 3, 3), shapely.box(71, 1, 72, 2)]),
+        # A single part inside the second area.
+        shapely.MultiPolygon([shapely.box(12, 2, 15, 5)]),
+        # Has a fragment inside the first area's hole.
+        shapely.MultiPolygon([shapely.box(30, 0, 40, 10), shapely.box(4.5, 4.5, 5.5, 5.5)]),
+        shapely.MultiPolygon([shapely.box(50, 0, 60, 10), shapely.box(70, 0, 75, 5)]),
+    ]
+
+
+def random_fragmented_country(seed, n_areas=8):
+    # Each area gets disjoint boxes of a few sizes, which often land in each other.
+    rng = np.random.default_rng(seed)
+    areas = []
+    for _ in range(n_areas):
+        parts = []
+        n_parts = rng.integers(1, 5)
+        while len(parts) < n_parts:
+            size = rng.choice([0.5, 2, 8])
+            x, y = rng.uniform(0, 30, size=2)
+            part = shapely.box(x, y, x + size, y + size)
+            if not any(part.intersects(other) for other in parts):
+                parts.append(part)
+        areas.append(shapely.MultiPolygon(parts))
+    return areas
+
+
+def assert_same_areas(cleaned, expected):
+    assert len(cleaned) == len(expected)
+    for area, expected_area in zip(cleaned, expected):
+        assert len(area.geoms) == len(expected_area.geoms)
+        assert area.equals(expected_area) or (area.is_empty and expected_area.is_empty)
+
+
+@pytest.mark.parametrize("seed", [None, 0, 1, 2, 3, 4])
+def test_cleaning_matches_brute_force(seed):
+    admin_polygons = fragmented_country() if seed is None else random_fragmented_country(seed)
+
+    assert_same_areas(process.clean_polygons_simple(admin_polygons), brute_force_clean_simple(admin_polygons))
+    cleaned = process.clean_polygons_max_diff_cutoff(admin_polygons)
+    assert_same_areas(cleaned, brute_force_clean_max_diff_cutoff(admin_polygons))
+
+    if seed is None:
+        # The first area keeps its fragment inside the last area, which the first
+        # pass doesn't compare against.
+        assert any(part.equals(shapely.box(52, 2, 53, 3)) for part in cleaned[0].geoms)
+        assert not any(part.equals(shapely.box(71, 1, 72, 2)) for part in cleaned[1].geoms)
+        assert cleaned[1].area == pytest.approx(100 - 9)
+        assert len(cleaned[3].geoms) == 1
@@ -0,0 +1,22 @@
+import numpy as np
+import shapely
+from voronoms.query import NO_AREA, AdminIndex
+
+
+def test_overlapping_polygons_match_tree():
+    # The second square overlaps the first, and the third lies entirely inside
+    # the first, so points in either overlap belong to the first square.
+    polygons = [shapely.box(0, 0, 10, 10), shapely.box(5, 5, 15, 15), shapely.box(2, 2, 4, 4)]
+    geonameids = [1, 2, 3]
+    x, y = np.random.default_rng(0).uniform(-1, 16, size=(2, 20000))
+
+    grid_index = AdminIndex(geonameids, polygons, grid_size=64)
+    tree_index = AdminIndex(geonameids, polygons, grid_size=0)
+    result = grid_index.lookup(x, y)
+
+    np.testing.assert_array_equal(result, tree_index.lookup(x, y))
+    in_first = (x > 0) & (x < 10) & (y > 0) & (y < 10)
+    in_second = (x > 5) & (x < 15) & (y > 5) & (y < 15)
+    assert (result[in_first] == 1).all()
+    assert (result[in_second & ~in_first] == 2).all()
+    assert (result[~in_first & ~in_second] == NO_AREA).all()
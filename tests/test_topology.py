@@ -0,0 +1,103 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from scipy.spatial import Voronoi
+from voronoms import export, process, topology
+
+
+def neighboring_areas(seed, n=800, n_areas=12):
+    """
+    Dissolves the Voronoi cells of random points into areas around a few random
+    centers, clipped to a disk, so that neighbors share their boundaries exactly.
+    """
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 10, size=(n, 2))
+    centers = rng.uniform(1, 9, size=(n_areas, 2))
+    labels = np.argmin(np.linalg.norm(points[:, None] - centers[None], axis=2), axis=1)
+    outline = shapely.Point(5, 5).buffer(4.5)
+    return process.dissolve_and_clip(Voronoi(points), labels, n_areas, outline)
+
+
+def decode_arcs(topojson):
+    translate = np.array(topojson["transform"]["translate"])
+    scale = np.array(topojson["transform"]["scale"])
+    return [np.cumsum(np.array(arc), axis=0) * scale + translate for arc in topojson["arcs"]]
+
+
+def decode_ring(ring, arcs):
+    points = []
+    for reference in ring:
+        arc = arcs[reference] if reference >= 0 else arcs[~reference][::-1]
+        points.extend(arc if not points else arc[1:])
+    return points
+
+
+def decode_geometry(geometry, arcs):
+    if geometry["type"] is None:
+        return shapely.MultiPolygon()
+    parts = geometry["arcs"] if geometry["type"] == "MultiPolygon" else [geometry["arcs"]]
+    rings = [[decode_ring(ring, arcs) for ring in part] for part in parts]
+    return shapely.MultiPolygon([shapely.Polygon(part[0], part[1:]) for part in rings])
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_topojson_decodes_to_polygons(tmp_path, seed):
+    polygons = neighboring_areas(seed) + [shapely.MultiPolygon()]
+    admin_geonames = pd.DataFrame(index=pd.Index(np.arange(len(polygons)) + 100, name="geonameid"))
+    filename = tmp_path / "XX-1.topojson"
+    export.geonames_topojson(admin_geonames, polygons, filename, quantization=10000)
+
+    with open(filename) as f:
+        topojson = json.load(f)
+    geometries = topojson["objects"]["XX-1"]["geometries"]
+    arcs = decode_arcs(topojson)
+    tolerance = np.hypot(*topojson["transform"]["scale"]) / 2 + 1e-9
+    assert [g["properties"]["geoNameId"] for g in geometries] == list(admin_geonames.index)
+    assert geometries[-1]["type"] is None
+    assert decode_geometry(geometries[-1], arcs).is_empty
+    for geometry, polygon in zip(geometries[:-1], polygons):
+        decoded = decode_geometry(geometry, arcs)
+        assert decoded.is_valid
+        assert shapely.hausdorff_distance(decoded, polygon) <= tolerance
+        assert decoded.symmetric_difference(polygon).area <= polygon.length * tolerance
+
+    # Each boundary between two areas is stored once, and the areas on either side
+    # of it run along it in opposite directions.
+    references = [
+        reference
+        for geometry in geometries if geometry["type"] is not None
+        for part in (geometry["arcs"] if geometry["type"] == "MultiPolygon" else [geometry["arcs"]])
+        for ring in part for reference in ring
+    ]
+    forward = np.bincount([r for r in references if r >= 0], minlength=len(arcs))
+    backward = np.bincount([~r for r in references if r < 0], minlength=len(arcs))
+    assert ((forward <= 1) & (backward <= 1)).all()
+    assert ((forward == 1) & (backward == 1)).sum() > len(polygons)
+    arc_points = sum(len(arc) for arc in topojson["arcs"])
+    assert arc_points < sum(shapely.get_num_coordinates(polygon) for polygon in polygons)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_levels_of_detail_keep_neighbors_apart(seed):
+    polygons = neighboring_areas(seed)
+    pyramid = topology.simplification_pyramid(polygons, [0.02, 0.1, 0.3])
+    neighbors = shapely.STRtree(polygons).query(polygons, predicate="intersects")
+    neighbors = neighbors[:, neighbors[0] < neighbors[1]]
+
+    assert topology.select_lod(pyramid) is pyramid[0]
+    vertices = []
+    for lod in pyramid:
+        level = topology.select_lod(pyramid, lod)
+        assert shapely.is_valid(level).all()
+        vertices.append(shapely.get_num_coordinates(level).sum())
+        for i, j in neighbors.T:
+            shared = level[i].intersection(level[j])
+            assert shared.area < 1e-9
+            assert shared.length > 0
+    assert vertices == sorted(vertices, reverse=True)
+    assert vertices[-1] < vertices[0] / 2
+
+    with pytest.raises(ValueError):
+        topology.select_lod(polygons, 1)
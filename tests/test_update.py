@@ -0,0 +1,86 @@
+from datetime import date, datetime, time, timedelta, timezone
+from email.utils import format_datetime
+from voronoms import load, update
+
+
+def geonames_rows(*rows):
+    lines = [
+        "{0}\t{1}\t{1}\t\t{2}\t{3}\tP\tPPL\t{4}\t\t01\t\t\t\t0\t\t0\tEurope/Paris\t2020-01-01\n".format(*row)
+        for row in rows
+    ]
+    return "".join(lines).encode()
+
+
+def serve_sources(server, *rows):
+    server.files["allCountries.txt"] = geonames_rows(*rows)
+    server.files["admin1CodesASCII.txt"] = b"AA.01\tOne\tOne\t100\n"
+    server.files["admin2Codes.txt"] = b"AA.01.001\tTwo\tTwo\t200\n"
+
+
+def test_update_patches_cached_table_once(geonames_server, monkeypatch):
+    serve_sources(
+        geonames_server,
+        (1, "Alpha", 10.0, 20.0, "AA"),
+        (2, "Beta", 11.0, 21.0, "AA"),
+        (3, "Gamma", 12.0, 22.0, "BB"),
+        (4, "Delta", 13.0, 23.0, "CC"),
+    )
+    # Row 2 is renamed, row 3 moves from BB to CC, and row 5 is added on the first
+    # day. Row 1 is deleted on the second, and row 5 is modified again.
+    geonames_server.files["modifications-2024-01-01.txt"] = geonames_rows(
+        (2, "Beta Prime", 11.0, 21.0, "AA"),
+        (3, "Gamma", 12.0, 22.0, "CC"),
+        (5, "Epsilon", 14.0, 24.0, "DD"),
+    )
+    geonames_server.files["deletes-2024-01-01.txt"] = b""
+    geonames_server.files["modifications-2024-01-02.txt"] = geonames_rows(
+        (5, "Epsilon Prime", 14.0, 24.0, "DD"),
+    )
+    geonames_server.files["deletes-2024-01-02.txt"] = b"1\tAlpha\tduplicate\n"
+    load.geonames()
+
+    prepare_calls = []
+    prepare_geonames = load.prepare_geonames
+
+    def counting_prepare_geonames(*args, **kwargs):
+        prepare_calls.append(args)
+        return prepare_geonames(*args, **kwargs)
+
+    monkeypatch.setattr(load, "prepare_geonames", counting_prepare_geonames)
+    patched, touched = update.update_geonames(dates=["2024-01-01", "2024-01-02", "2024-01-03"])
+
+    assert len(prepare_calls) == 1
+    assert list(patched.index) == [2, 3, 4, 5]
+    assert list(patched.name) == ["Beta Prime", "Gamma", "Delta", "Epsilon Prime"]
+    assert list(patched.country_code) == ["AA", "CC", "CC", "DD"]
+    # BB is touched because the row it lost moved to CC.
+    assert touched == {"AA", "BB", "CC", "DD"}
+    assert update.dirty_countries() == {
+        "AA": "2024-01-02",
+        "BB": "2024-01-01",
+        "CC": "2024-01-01",
+        "DD": "2024-01-02",
+    }
+    assert update.read_delta_record(load.geonames.cache_key())["applied"] == ["2024-01-01", "2024-01-02"]
+
+    cached = load.geonames()
+    assert list(cached.index) == [2, 3, 4, 5]
+    assert list(cached.name) == list(patched.name)
+    assert len(prepare_calls) == 1
+
+
+def test_pending_dates_start_from_dump(geonames_server):
+    serve_sources(geonames_server, (1, "Alpha", 10.0, 20.0, "AA"))
+    dump = date.today() - timedelta(days=3)
+    geonames_server.last_modified = format_datetime(
+        datetime.combine(dump, time(12), timezone.utc), usegmt=True
+    )
+    load.geonames()
+
+    yesterday = date.today() - timedelta(days=1)
+    record = update.read_delta_record(load.geonames.cache_key())
+    assert update.pending_dates(record) == [dump - timedelta(days=1) + timedelta(days=n) for n in range(4)]
+    record["applied"] = [str(yesterday - timedelta(days=2)), str(yesterday - timedelta(days=1))]
+    assert update.pending_dates(record) == [yesterday]
+    record["applied"].append(str(yesterday))
+    assert update.pending_dates(record) == []
@@ -0,0 +1,179 @@
+import hashlib
+import inspect
+import pickle
+import re
+from functools import wraps
+from pathlib import Path
+import pandas as pd
+import shapely
+from . import data
+from .download import geonames_file
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+"""
+This module caches the datasets that `voronoms.load` builds from GeoNames files,
+keyed by the arguments they were built with and the source files they came from.
+"""
+
+
+DATA_DIR = Path(data.__file__).parent
+CACHE_DIR = Path(DATA_DIR, "cache")
+if not CACHE_DIR.exists():
+    CACHE_DIR.mkdir(parents=True)
+
+SAMPLE_BYTES = 1024 * 1024
+
+
+def check_cache(cache_name, *source_names):
+    """
+    Caches the result of a dataset-building function.
+
+    Arguments:
+        cache_name: The name the cache entries are stored under.
+        source_names: The names of the GeoNames files the dataset is built from.
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def key_for(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            source_paths = [geonames_file(name) for name in source_names]
+            return cache_key(cache_name, arguments.arguments, source_paths)
+
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            key = key_for(*args, **kwargs)
+            cached = read_cached(cache_name, key)
+            if cached is not None:
+                print("Loading cached '{}'.".format(cache_name))
+                return cached
+            print("Building from original file.")
+            built_dataset = fn(*args, **kwargs)
+            write_cached(cache_name, key, built_dataset)
+            print("Saved '{}' to cache.".format(cache_name))
+            return built_dataset
+        # Lets callers such as `voronoms.update` find the entry for some arguments.
+        decorated.cache_name = cache_name
+        decorated.cache_key = key_for
+        return decorated
+    return decorator
+
+
+def cache_key(cache_name, arguments, source_paths):
+    """
+    Returns the key for a dataset built with some arguments from some source files.
+    """
+    arguments_key = hashlib.sha1()
+    arguments_key.update(cache_name.encode())
+    arguments_key.update(repr(sorted(arguments.items())).encode())
+    sources_key = hashlib.sha1()
+    for source_path in source_paths:
+        sources_key.update(source_signature(source_path).encode())
+    return "{}-{}".format(arguments_key.hexdigest()[:16], sources_key.hexdigest()[:16])
+
+
+def source_signature(source_path):
+    """
+    Summarizes a source file by its name, size, modification time and ends.
+    """
+    stat = Path(source_path).stat()
+    digest = hashlib.sha1()
+    with open(source_path, "rb") as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if stat.st_size > SAMPLE_BYTES:
+            f.seek(max(SAMPLE_BYTES, stat.st_size - SAMPLE_BYTES))
+            digest.update(f.read(SAMPLE_BYTES))
+    return "{}:{}:{}:{}".format(Path(source_path).name, stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def cached_paths(cache_name):
+    """
+    Returns the paths of a dataset's cache entries, keyed by their keys.
+    """
+    paths = {}
+    for path in CACHE_DIR.glob("{}-*".format(cache_name)):
+        key = path.name.split(".")[0][len(cache_name) + 1:]
+        if re.fullmatch("[0-9a-f]{16}(-[0-9a-f]{16})?", key):
+            paths[key] = path
+    return paths
+
+
+def cached_path(cache_name, key):
+    return cached_paths(cache_name).get(key)
+
+
+def read_cached(cache_name, key):
+    """
+    Reads a cache entry, or returns None if there isn't one for the key.
+    """
+    path = cached_path(cache_name, key)
+    if path is None:
+        return None
+    if path.suffix == ".feather":
+        table = feather.read_table(path, memory_map=True)
+        frame = table.to_pandas()
+        geometry_columns = (table.schema.metadata or {}).get(b"voronoms_geometry", b"")
+        for col in geometry_columns.decode().split(","):
+            if col in frame.columns:
+                frame[col] = shapely.from_wkb(frame[col].to_numpy())
+        return frame
+    if path.suffix == ".wkb":
+        return shapely.from_wkb(path.read_bytes())
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def write_cached(cache_name, key, dataset):
+    """
+    Writes a cache entry, deleting the dataset's entries from other source files.
+    """
+    delete_cached(cache_name, keep_sources=key.split("-")[1])
+    previous_path = cached_path(cache_name, key)
+    if previous_path is not None:
+        previous_path.unlink()
+    if feather is not None and isinstance(dataset, pd.DataFrame):
+        path = Path(CACHE_DIR, "{}-{}.feather".format(cache_name, key))
+        dataset = dataset.copy(deep=False)
+        geometry_columns = [
+            col for col in dataset.columns
+            if dataset[col].dtype == object and is_geometry_column(dataset[col])
+        ]
+        for col in geometry_columns:
+            dataset[col] = shapely.to_wkb(dataset[col].to_numpy())
+        table = pyarrow.Table.from_pandas(dataset)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"voronoms_geometry"] = ",".join(geometry_columns).encode()
+        table = table.replace_schema_metadata(metadata)
+        feather.write_feather(table, path, compression="uncompressed")
+    elif isinstance(dataset, shapely.Geometry):
+        path = Path(CACHE_DIR, "{}-{}.wkb".format(cache_name, key))
+        path.write_bytes(shapely.to_wkb(dataset))
+    else:
+        path = Path(CACHE_DIR, "{}-{}.pickle".format(cache_name, key))
+        with open(path, "wb") as f:
+            pickle.dump(dataset, f)
+    return path
+
+
+def is_geometry_column(column):
+    valid = column.notna().to_numpy()
+    return valid.any() and isinstance(column.iloc[valid.argmax()], shapely.Geometry)
+
+
+def delete_cached(cache_name, keep_sources=None):
+    """
+    Deletes a dataset's cache entries, except those built from `keep_sources`,
+    the sources part of a key.
+    """
+    for key, path in cached_paths(cache_name).items():
+        if keep_sources is None or key.partition("-")[2] != keep_sources:
+            path.unlink()
+    # Older versions pickled the dataset under its bare name.
+    Path(CACHE_DIR, "{}.pickle".format(cache_name)).unlink(missing_ok=True)
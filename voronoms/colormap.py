@@ -1,3 +1,5 @@
+import numpy as np
+
 # From https://gist.github.com/mikhailov-work/ee72ba4191942acecc03fe6da94fc73f#file-turbo_colormap-py
 
 # Copyright 2019 Google LLC.
@@ -290,16 +292,65 @@ def interpolate_or_clip(colormap, x):
 
 
 def rescale_and_interpolate(colormap, x):
-    u = max(x)
-    l = min(x)
-    if min(x) == 0 and max(x) == 0:
-        rescaled_x = x
-    elif abs(u + l) == abs(u) + abs(l):
-        rescaled_x = [(e - min(x)) / (max(x) - min(x)) for e in x]
-    elif abs(u + l) != abs(u) + abs(l):
-        factor = 2 * max(abs(min(x)), abs(max(x)))
-        rescaled_x = [(e / factor) + 0.5 for e in x]
-    else:
-        rescaled_x = x
-        
-    return [interpolate(colormap, e) for e in rescaled_x]
+    """
+    Rescales values onto the colormap and returns their colors, as an (N, 3)
+    array. Values of one sign are stretched across the whole colormap, and values
+    of both signs are centered on its middle.
+    """
+    return Colormap(colormap).rescale_and_interpolate(x)
+
+
+# Vectorized colormaps
+#
+# A `Colormap` keeps its table as a NumPy array and colors whole arrays of values
+# at once. Its results are the same as those of the functions above, to the last
+# bit, since it does the same floating point operations in the same order.
+
+
+class Colormap:
+    def __init__(self, colormap):
+        self.table = np.asarray(colormap, dtype=np.float64)
+
+    def interpolate(self, x):
+        """
+        Returns the colors of values in [0, 1], clamping any outside it, as an
+        array with a trailing axis of RGB values.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        # NaNs go to the top of the table, as `min` and `max` send them.
+        x = np.where(np.isnan(x), 1.0, np.clip(x, 0.0, 1.0))
+        a = (x * 255.0).astype(np.intp)
+        b = np.minimum(255, a + 1)
+        f = (x * 255.0 - a)[..., np.newaxis]
+        return self.table[a] + (self.table[b] - self.table[a]) * f
+
+    def interpolate_or_clip(self, x):
+        """
+        Returns the colors of values in [0, 1], with black for values below it and
+        white for values above it.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        colors = self.interpolate(x)
+        colors[x < 0.0] = 0.0
+        colors[x > 1.0] = 1.0
+        return colors
+
+    def rescale_and_interpolate(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if x.size == 0:
+            return np.empty(x.shape + (3,))
+        u = x.max()
+        l = x.min()
+        if l == 0 and u == 0:
+            rescaled_x = x
+        elif abs(u + l) == abs(u) + abs(l):
+            if u == l:
+                raise ZeroDivisionError("Can't rescale values that are all the same.")
+            rescaled_x = (x - l) / (u - l)
+        else:
+            factor = 2 * max(abs(l), abs(u))
+            rescaled_x = (x / factor) + 0.5
+        return self.interpolate(rescaled_x)
+
+
+turbo = Colormap(turbo_colormap_data)
@@ -0,0 +1,125 @@
+import numpy as np
+from collections import defaultdict
+from math import atan2, pi
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.prepared import prep
+
+
+"""
+This module merges the cells of a Voronoi diagram into admin areas by tracing
+the ridges between cells of different areas, rather than by unioning cells.
+"""
+
+
+def dissolve_voronoi(voronoi, labels, n_labels):
+    """
+    Merges the cells of a Voronoi diagram into a MultiPolygon for each of
+    `n_labels` labels, given a label for each point, or -1 for none.
+    """
+    # As when unioning cells, unbounded cells are left out.
+    labels = np.asarray(labels)
+    finite = np.array(
+        [len(region) > 0 and -1 not in region for region in voronoi.regions]
+    )[voronoi.point_region]
+    labels = np.where(finite, labels, -1)
+
+    ridge_points = np.asarray(voronoi.ridge_points)
+    ridge_vertices = np.asarray(voronoi.ridge_vertices)
+    bounded = (ridge_vertices >= 0).all(axis=1)
+    ridge_points = ridge_points[bounded]
+    ridge_vertices = ridge_vertices[bounded]
+
+    left_labels = labels[ridge_points[:, 0]]
+    right_labels = labels[ridge_points[:, 1]]
+    outline = left_labels != right_labels
+
+    # Each outline ridge is an edge of the area on either side of it, if there
+    # is one. Edges are oriented so that their area lies on the left.
+    edges = defaultdict(list)
+    for side in (0, 1):
+        on_side = outline & (labels[ridge_points[:, side]] >= 0)
+        points = voronoi.points[ridge_points[on_side, side]]
+        start = ridge_vertices[on_side, 0]
+        end = ridge_vertices[on_side, 1]
+        a = voronoi.vertices[start]
+        b = voronoi.vertices[end]
+        cross = (b[:, 0] - a[:, 0]) * (points[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (points[:, 0] - a[:, 0])
+        flip = cross < 0
+        start, end = np.where(flip, end, start), np.where(flip, start, end)
+        for label, u, v in zip(labels[ridge_points[on_side, side]], start, end):
+            if u != v:
+                edges[label].append((u, v))
+
+    return [
+        rings_to_multipolygon(stitch_rings(edges.get(label, []), voronoi.vertices), voronoi.vertices)
+        for label in range(n_labels)
+    ]
+
+
+def stitch_rings(edges, vertices):
+    """
+    Joins directed edges into closed rings of vertex indices, taking the sharpest
+    left turn where several edges leave a vertex.
+    """
+    outgoing = defaultdict(list)
+    for u, v in edges:
+        outgoing[u].append(v)
+
+    rings = []
+    for first in list(outgoing):
+        while outgoing[first]:
+            ring = [first]
+            previous, current = first, outgoing[first].pop()
+            while current != first:
+                ring.append(current)
+                candidates = outgoing[current]
+                if len(candidates) == 1:
+                    following = candidates.pop()
+                else:
+                    following = candidates.pop(left_turn(vertices, previous, current, candidates))
+                previous, current = current, following
+            rings.append(ring)
+    return rings
+
+
+def left_turn(vertices, previous, current, candidates):
+    """
+    Returns the position of the candidate making the sharpest left turn.
+    """
+    x, y = vertices[current]
+    back = atan2(vertices[previous][1] - y, vertices[previous][0] - x)
+    turns = []
+    for candidate in candidates:
+        angle = atan2(vertices[candidate][1] - y, vertices[candidate][0] - x)
+        turns.append((back - angle) % (2 * pi))
+    return int(np.argmin(turns))
+
+
+def rings_to_multipolygon(rings, vertices):
+    """
+    Assembles counter-clockwise shells and clockwise holes into a MultiPolygon.
+    """
+    shells = []
+    holes = []
+    for ring in rings:
+        if len(ring) < 3:
+            continue
+        ring_polygon = Polygon(vertices[ring])
+        if ring_polygon.exterior.is_ccw:
+            shells.append(ring_polygon)
+        else:
+            holes.append(ring_polygon)
+
+    # Each hole goes in the smallest shell that covers it.
+    shells.sort(key=lambda shell: shell.area)
+    prepared_shells = [prep(shell) for shell in shells]
+    shell_holes = [[] for shell in shells]
+    for hole in holes:
+        for i, prepared_shell in enumerate(prepared_shells):
+            if prepared_shell.covers(hole):
+                shell_holes[i].append(hole.exterior.coords)
+                break
+
+    return MultiPolygon(
+        [Polygon(shell.exterior.coords, holes) for shell, holes in zip(shells, shell_holes)]
+    )
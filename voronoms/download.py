@@ -1,48 +1,191 @@
+import json
+import os
+import shutil
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import Lock
 from zipfile import ZipFile
-from io import BytesIO
+from requests.adapters import HTTPAdapter
 from . import data
 
 
+"""
+This module downloads GeoNames files into the package's data directory, resuming
+interrupted downloads and revalidating files that are already there.
+"""
+
+
 DATA_DIR = Path(data.__file__).parent
 GEONAMES_DIR = Path(DATA_DIR, "GeoNames")
 if not GEONAMES_DIR.exists():
     GEONAMES_DIR.mkdir(parents=True)
 
+GEONAMES_URL = "http://download.geonames.org/export/dump/"
+
+# The files Voronoms builds its datasets from.
+GEONAMES_FILES = [
+    "allCountries.txt",
+    "shapes_all_low.txt",
+    "admin1CodesASCII.txt",
+    "admin2Codes.txt",
+    "hierarchy.txt",
+]
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+MAX_CONNECTIONS = 8
+
+SESSION = None
+SESSION_LOCK = Lock()
+
+
+def get_session():
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_CONNECTIONS, pool_maxsize=MAX_CONNECTIONS)
+            SESSION.mount("http://", adapter)
+            SESSION.mount("https://", adapter)
+        return SESSION
+
 
-def geonames_file(file_name):
-    geonames_url = "http://download.geonames.org/export/dump/"
+def geonames_file(file_name, revalidate=False):
+    """
+    Returns the path to a GeoNames file, downloading it or its zipped version first
+    if it isn't there, or if `revalidate` is True and it's changed on the server.
+    """
     file_path = Path(GEONAMES_DIR, file_name)
-    if file_path.exists():
+    if file_path.exists() and not revalidate:
         print("File '{}' already exists locally.".format(file_name))
         return file_path
-    download_name = file_name
-    print("Downloading target file '{}'.".format(file_name))
-    response = requests.get(geonames_url + download_name)
-    if response.status_code == 404:
-        download_name = Path(file_name).stem + ".zip"
-        print("File not found on geonames.org.")
-        print("Downloading corresponding zip '{}'.".format(download_name))
-        response = requests.get(geonames_url + download_name)
-
-    zipped = True if "zip" in response.headers["Content-Type"] else False
-
-    if zipped:
-        with ZipFile(BytesIO(response.content)) as z:
-            for f in z.namelist():
-                if f == file_name:
-                    z.extract(f, GEONAMES_DIR)
-        if file_path.exists():
-            print("Extracted file '{}'.".format(file_name))
-            return file_path
+
+    validators = read_validators(file_name) if file_path.exists() else {}
+    download_names = [file_name, Path(file_name).stem + ".zip"]
+    if validators.get("download_name") in download_names:
+        download_names.remove(validators["download_name"])
+        download_names.insert(0, validators["download_name"])
+
+    for download_name in download_names:
+        if download_name != file_name:
+            print("Downloading corresponding zip '{}'.".format(download_name))
         else:
-            raise Exception("Could not extract target from zip file.")
-    else:
-        with open(Path(GEONAMES_DIR, download_name), "wb") as f:
-            f.write(response.content)
-        if file_path.exists():
-            print("Downloaded file '{}'.".format(file_name))
+            print("Downloading target file '{}'.".format(file_name))
+        status, headers = download(download_name, validators)
+        if status == 304:
+            print("File '{}' is up to date.".format(file_name))
             return file_path
+        if status != 404:
+            break
+        print("File '{}' not found on geonames.org.".format(download_name))
+    else:
+        raise FileNotFoundError("Could not find '{}' on geonames.org.".format(file_name))
+
+    download_path = Path(GEONAMES_DIR, download_name)
+    if download_name != file_name or "zip" in headers.get("Content-Type", ""):
+        extract(download_path, file_name)
+        download_path.unlink()
+        print("Extracted file '{}'.".format(file_name))
+    else:
+        print("Downloaded file '{}'.".format(file_name))
+    write_validators(file_name, {
+        "download_name": download_name,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    })
+    return file_path
+
+
+def geonames_files(file_names=GEONAMES_FILES, revalidate=False, workers=4):
+    """
+    Fetches several GeoNames files concurrently and returns their paths in order.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda name: geonames_file(name, revalidate), file_names))
+
+
+def download(download_name, validators=None):
+    """
+    Streams a file from GeoNames into the data directory, resuming a partial
+    download, and returns the response's status code and headers.
+    """
+    download_path = Path(GEONAMES_DIR, download_name)
+    part_path = download_path.with_name(download_name + ".part")
+    part_validators_path = part_path.with_name(part_path.name + ".json")
+    url = GEONAMES_URL + download_name
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    # Resume a partial download, unless the file has changed on the server since.
+    resume_from = 0
+    if part_path.exists() and part_validators_path.exists():
+        with open(part_validators_path) as f:
+            part_validators = json.load(f)
+        if_range = part_validators.get("etag") or part_validators.get("last_modified")
+        if if_range and part_path.stat().st_size > 0:
+            resume_from = part_path.stat().st_size
+            headers["Range"] = "bytes={}-".format(resume_from)
+            headers["If-Range"] = if_range
+
+    session = get_session()
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            # The partial download can't be resumed, so start over.
+            part_path.unlink()
+            return download(download_name, validators)
+        if response.status_code not in (200, 206):
+            if response.status_code not in (304, 404):
+                response.raise_for_status()
+            return response.status_code, response.headers
+        if response.status_code == 206:
+            print("Resuming '{}' from {} bytes.".format(download_name, resume_from))
+            mode = "ab"
         else:
-            raise Exception("Could not save file.")
+            mode = "wb"
+            with open(part_validators_path, "w") as f:
+                json.dump({
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }, f)
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(part_path, download_path)
+        part_validators_path.unlink(missing_ok=True)
+        return response.status_code, response.headers
+
+
+def extract(zip_path, file_name):
+    """
+    Extracts a file from a zip archive on disk.
+    """
+    file_path = Path(GEONAMES_DIR, file_name)
+    temp_path = file_path.with_name(file_name + ".extracting")
+    with ZipFile(zip_path) as z:
+        if file_name not in z.namelist():
+            raise Exception("Could not extract target from zip file.")
+        with z.open(file_name) as source, open(temp_path, "wb") as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+    os.replace(temp_path, file_path)
+
+
+def validators_path(file_name):
+    return Path(GEONAMES_DIR, ".{}.json".format(file_name))
+
+
+def read_validators(file_name):
+    path = validators_path(file_name)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_validators(file_name, validators):
+    with open(validators_path(file_name), "w") as f:
+        json.dump(validators, f)
@@ -1,25 +1,396 @@
-import pandas as pd
-import geopandas as gpd
+import gzip
 import json
+import os
+import numpy as np
+import shapely
 from . import data
+from .statistics import geodesic_area_perimeter
+from .topology import DEFAULT_QUANTIZATION, select_lod, topology
 from pathlib import Path
 
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+
+"""
+This module writes Voronoms polygons to GeoJSON, text, TopoJSON and GeoParquet
+files, laid out as GDAL and pandas wrote them.
+"""
+
 
 DATA_DIR = Path(data.__file__).parent
 EXPORT_DIR = Path(DATA_DIR, "export")
 if not EXPORT_DIR.exists():
     EXPORT_DIR.mkdir(parents=True)
 
+# How geometries are laid out: the opening and closing of arrays, and a template
+# for the geometry object.
+GDAL_STYLE = ("[ ", " ]", '{{ "type": "{}", "coordinates": {} }}')
+JSON_STYLE = ("[", "]", '{{"type": "{}", "coordinates": {}}}')
+
+# GDAL writes coordinates to 15 decimal places by default.
+GDAL_PRECISION = 15
+
+
+def geonames_json(
+    admin_geonames, admin_polygons, filename, precision=None, compress=False, lod=None, measures=False
+):
+    """
+    Writes admin polygons to a GeoJSON file, as GDAL would.
+
+    Arguments:
+        precision: The number of decimal places coordinates are written with, 15
+            by default.
+        compress: If True, the file is gzipped.
+        lod: The level of detail to write, if `admin_polygons` is a
+            simplification pyramid.
+        measures: If True, each polygon's area and perimeter are written too.
+    """
+    if precision is None:
+        precision = GDAL_PRECISION
+    polygons = select_lod(admin_polygons, lod)
+    geometries = geometry_json(polygons, precision, GDAL_STYLE)
+    properties = ['"geoNameId": {}'.format(geonameid) for geonameid in admin_geonames.index]
+    if measures:
+        properties = [
+            '{}, "areaKm2": {:.3f}, "perimeterKm": {:.3f}'.format(p, area, perimeter)
+            for p, area, perimeter in zip(properties, *polygon_measures(polygons))
+        ]
+    layer_name = Path(filename).name.split(".")[0]
+    with open_export(filename, compress) as f:
+        f.write('{{\n"type": "FeatureCollection",\n"name": "{}",\n"features": [\n'.format(layer_name))
+        for i, (feature_properties, geometry) in enumerate(zip(properties, geometries)):
+            if i > 0:
+                f.write(",\n")
+            f.write('{{ "type": "Feature", "properties": {{ {} }}, "geometry": {} }}'.format(
+                feature_properties, geometry
+            ))
+        f.write("\n]\n}\n")
+
+
+def geonames_table(
+    admin_geonames, admin_polygons, filename, precision=None, compress=False, lod=None, measures=False
+):
+    """
+    Writes admin polygons to a tab-separated table with `geoNameId` and `geoJSON`
+    columns. The other arguments are as for `geonames_json`, except that
+    coordinates are written as Python writes floats by default.
+    """
+    polygons = select_lod(admin_polygons, lod)
+    geometries = geometry_json(polygons, precision, JSON_STYLE)
+    rows = ['{}\t"{}"'.format(geonameid, geometry.replace('"', '""'))
+            for geonameid, geometry in zip(admin_geonames.index, geometries)]
+    header = "geoNameId\tgeoJSON"
+    if measures:
+        header += "\tareaKm2\tperimeterKm"
+        rows = [
+            "{}\t{:.3f}\t{:.3f}".format(row, area, perimeter)
+            for row, area, perimeter in zip(rows, *polygon_measures(polygons))
+        ]
+    with open_export(filename, compress) as f:
+        f.write(header + "\n")
+        for row in rows:
+            f.write(row + "\n")
+
+
+def geonames_topojson(
+    admin_geonames, admin_polygons, filename, quantization=DEFAULT_QUANTIZATION, compress=False, lod=None,
+    measures=False,
+):
+    """
+    Writes admin polygons to a TopoJSON file, with coordinates quantized to a grid
+    of `quantization` values along each axis. The other arguments are as for
+    `geonames_json`.
+    """
+    polygons = select_lod(admin_polygons, lod)
+    layer_name = Path(filename).name.split(".")[0]
+    properties = [{"geoNameId": int(geonameid)} for geonameid in admin_geonames.index]
+    if measures:
+        for p, area, perimeter in zip(properties, *polygon_measures(polygons)):
+            p["areaKm2"] = round(float(area), 3)
+            p["perimeterKm"] = round(float(perimeter), 3)
+    topojson = topology(polygons, properties, layer_name, quantization)
+    with open_export(filename, compress) as f:
+        json.dump(topojson, f, separators=(",", ":"))
+
+
+def polygon_measures(polygons):
+    """
+    Returns the geodesic areas of polygons in square kilometers and their
+    perimeters in kilometers.
+    """
+    areas, perimeters = geodesic_area_perimeter(polygons)
+    return areas / 1000000, perimeters / 1000
+
+
+def open_export(filename, compress=False):
+    if compress:
+        return gzip.open(filename, "wt", encoding="utf-8", newline="", compresslevel=6)
+    return open(filename, "w", encoding="utf-8", newline="")
+
+
+def geometry_json(polygons, precision=None, style=JSON_STYLE):
+    """
+    Returns a list of GeoJSON geometry strings for a list of polygons.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    start, stop, template = style
+    geometries = [None] * len(polygons)
+
+    # The coordinates of all the non-empty Polygons and MultiPolygons are
+    # formatted in one go; anything else is formatted on its own.
+    type_ids = shapely.get_type_id(polygons)
+    polygonal = np.isin(type_ids, [3, 6]) & ~shapely.is_empty(polygons)
+    if polygonal.any():
+        _, coords, offsets = shapely.to_ragged_array(polygons[polygonal])
+        if len(offsets) == 2:
+            # Only Polygons, each of which is its own single part.
+            ring_offsets, part_offsets = offsets
+            geometry_offsets = np.arange(len(part_offsets))
+        else:
+            ring_offsets, part_offsets, geometry_offsets = offsets
+        xs = format_numbers(coords[:, 0], precision)
+        ys = format_numbers(coords[:, 1], precision)
+        points = [start + x + ", " + y + stop for x, y in zip(xs, ys)]
+        rings = [
+            start + ", ".join(points[a:b]) + stop
+            for a, b in zip(ring_offsets[:-1], ring_offsets[1:])
+        ]
+        parts = [
+            start + ", ".join(rings[a:b]) + stop
+            for a, b in zip(part_offsets[:-1], part_offsets[1:])
+        ]
+        for i, a, b in zip(np.flatnonzero(polygonal), geometry_offsets[:-1], geometry_offsets[1:]):
+            if type_ids[i] == 3:
+                geometries[i] = template.format("Polygon", parts[a])
+            else:
+                geometries[i] = template.format("MultiPolygon", start + ", ".join(parts[a:b]) + stop)
+
+    for i in np.flatnonzero(~polygonal):
+        if polygons[i] is None:
+            geometries[i] = "null"
+        else:
+            geometries[i] = format_geo_interface(polygons[i].__geo_interface__, precision, style)
+    return geometries
+
+
+def format_numbers(values, precision=None):
+    """
+    Formats an array of floats as GDAL does with a precision, or as Python does.
+    """
+    values = np.asarray(values, dtype=np.float64).tolist()
+    if precision is None:
+        return [repr(value) for value in values]
+    template = "%.{}f".format(precision)
+    strings = [template % value for value in values]
+    if precision == 0:
+        return strings
+    # GDAL only treats numbers that end in runs of zeros or nines specially, so
+    # only those go through `gdal_number`.
+    strings = [
+        gdal_number(value, precision)
+        if string[-6:-1] in ("00000", "99999") or string[-9:-7] in ("00", "99")
+        else trim_zeros(string)
+        for value, string in zip(values, strings)
+    ]
+    return strings
+
+
+def gdal_number(value, precision):
+    """
+    Formats a float to a number of decimal places as GDAL's `OGRFormatDouble` does.
+    """
+    string = "%.{}f".format(precision) % value
+    length = len(string)
+    if length <= 10 or "." not in string:
+        return trim_zeros(string)
+    dot = string.index(".")
+    before_dot = dot - 1 - string.startswith("-")
+
+    def run_of(digit, places):
+        # Whether the digits from 9 places from the end to the second to last are
+        # all `digit`, where the later ones are only checked for small numbers.
+        return dot < length - places + 1 and all(
+            before_dot >= k + 1 or string[length - k] == digit for k in range(3, 8)
+        ) and string[length - 8] == digit and string[length - 9] == digit
+
+    if string[-6:-1] == "00000":
+        string = string[:-1]
+    elif run_of("0", 9):
+        string = string[:-8]
+    elif string[-6:-1] == "99999":
+        string = round_up(string[:-6])
+    elif run_of("9", 10):
+        string = round_up(string[:-9])
+    return trim_zeros(string)
+
+
+def round_up(string):
+    """
+    Adds one to the last digit of a formatted number, carrying as needed.
+    """
+    digits = list(string)
+    for i in range(len(digits) - 1, -1, -1):
+        if digits[i] == ".":
+            continue
+        if digits[i] == "-":
+            break
+        if digits[i] != "9":
+            digits[i] = chr(ord(digits[i]) + 1)
+            return "".join(digits)
+        digits[i] = "0"
+    sign = 1 if string.startswith("-") else 0
+    return "".join(digits[:sign] + ["1"] + digits[sign:])
+
+
+def trim_zeros(string):
+    if "." not in string:
+        return string
+    string = string.rstrip("0")
+    return string + "0" if string.endswith(".") else string
+
+
+def format_coordinates(coordinates, precision=None, style=JSON_STYLE):
+    start, stop, template = style
+    if len(coordinates) == 0:
+        # GDAL writes an empty array as "[ ]".
+        return start.rstrip() + stop
+    if len(coordinates) > 0 and not isinstance(coordinates[0], (tuple, list)):
+        return start + ", ".join(format_numbers(coordinates, precision)) + stop
+    return start + ", ".join(format_coordinates(c, precision, style) for c in coordinates) + stop
+
+
+def format_geo_interface(geo_interface, precision=None, style=JSON_STYLE):
+    start, stop, template = style
+    if "geometries" in geo_interface:
+        members = [format_geo_interface(g, precision, style) for g in geo_interface["geometries"]]
+        return template.replace('"coordinates"', '"geometries"').format(
+            geo_interface["type"], start + ", ".join(members) + stop
+        )
+    return template.format(
+        geo_interface["type"], format_coordinates(geo_interface["coordinates"], precision, style)
+    )
+
+
+# GeoParquet
+#
+# The GeoParquet file holds one row per admin area, with its country, admin level,
+# GeoNames id, WKB geometry and bounding box. Each task is written as its own row
+# group, so the row groups' statistics let readers skip to the countries, levels
+# and bounding boxes they want without reading the rest of the file.
+
+BBOX_FIELDS = ["xmin", "ymin", "xmax", "ymax"]
+
+GEOPARQUET_METADATA = {
+    "version": "1.1.0",
+    "primary_column": "geometry",
+    "columns": {
+        "geometry": {
+            "encoding": "WKB",
+            "geometry_types": [],
+            "covering": {"bbox": {field: ["bbox", field] for field in BBOX_FIELDS}},
+        }
+    },
+}
+
+
+def geoparquet_schema():
+    return pyarrow.schema(
+        [
+            ("country", pyarrow.string()),
+            ("level", pyarrow.int8()),
+            ("lod", pyarrow.int8()),
+            ("geonameid", pyarrow.int64()),
+            ("geometry", pyarrow.binary()),
+            ("bbox", pyarrow.struct([(field, pyarrow.float64()) for field in BBOX_FIELDS])),
+            ("area_km2", pyarrow.float64()),
+            ("perimeter_km", pyarrow.float64()),
+        ],
+        metadata={"geo": json.dumps(GEOPARQUET_METADATA)},
+    )
+
+
+def geoparquet_table(country, admin_level, admin_geonames, admin_polygons, lod=None, measures=False):
+    """
+    Returns a task's polygons at a level of detail as a table for `GeoParquetWriter`.
+    """
+    if pyarrow is None:
+        raise ImportError("Writing GeoParquet requires pyarrow.")
+    polygons = np.asarray(select_lod(admin_polygons, lod), dtype=object)
+    bounds = shapely.bounds(polygons)
+    if measures:
+        areas, perimeters = polygon_measures(polygons)
+    else:
+        areas = perimeters = pyarrow.nulls(len(polygons), pyarrow.float64())
+    return pyarrow.table(
+        {
+            "country": pyarrow.array([country] * len(polygons), pyarrow.string()),
+            "level": pyarrow.array(np.full(len(polygons), admin_level, dtype=np.int8)),
+            "lod": pyarrow.array(np.full(len(polygons), lod or 0, dtype=np.int8)),
+            "geonameid": pyarrow.array(admin_geonames.index.to_numpy(dtype=np.int64)),
+            "geometry": pyarrow.array(shapely.to_wkb(polygons), pyarrow.binary()),
+            "bbox": pyarrow.StructArray.from_arrays(
+                [pyarrow.array(bounds[:, i]) for i in range(4)], names=BBOX_FIELDS
+            ),
+            "area_km2": pyarrow.array(areas, pyarrow.float64()),
+            "perimeter_km": pyarrow.array(perimeters, pyarrow.float64()),
+        },
+        schema=geoparquet_schema(),
+    )
+
+
+class GeoParquetWriter:
+    """
+    Collects tasks' polygons into a single GeoParquet file, with a row group for
+    each task and level of detail, keeping an existing file's other row groups.
+    """
+
+    def __init__(self, filename, compression="zstd"):
+        if pyarrow is None:
+            raise ImportError("Writing GeoParquet requires pyarrow.")
+        self.filename = Path(filename)
+        self.temp_filename = self.filename.with_name(self.filename.name + ".part")
+        self.writer = parquet.ParquetWriter(
+            self.temp_filename, geoparquet_schema(), compression=compression
+        )
+        self.written = set()
+
+    def write_task(self, table):
+        """
+        Writes a table from `geoparquet_table` as a row group.
+        """
+        if table.num_rows == 0:
+            return
+        self.writer.write_table(table, row_group_size=table.num_rows)
+        self.written.add(task_of(table))
+
+    def close(self):
+        if self.writer is None:
+            return
+        previous = None
+        if self.filename.exists():
+            previous = parquet.ParquetFile(self.filename)
+            if not previous.schema_arrow.equals(geoparquet_schema()):
+                print("'{}' has an older schema, so its rows aren't carried over.".format(self.filename.name))
+                previous = None
+        if previous is not None:
+            for i in range(previous.num_row_groups):
+                row_group = previous.read_row_group(i)
+                if row_group.num_rows > 0 and task_of(row_group) not in self.written:
+                    self.writer.write_table(row_group, row_group_size=row_group.num_rows)
+        self.writer.close()
+        self.writer = None
+        os.replace(self.temp_filename, self.filename)
+
+    def __enter__(self):
+        return self
 
-def geonames_json(admin_geonames, admin_polygons, filename):
-    admin_geonames["geometry"] = admin_polygons
-    admin_gdf = gpd.GeoDataFrame(admin_geonames.filter(["geonameid", "geometry"]))
-    admin_gdf["geoNameId"] = admin_gdf.index
-    admin_gdf.to_file(filename, driver="GeoJSON")
+    def __exit__(self, *exc_info):
+        self.close()
 
 
-def geonames_table(admin_geonames, admin_polygons, filename):
-    admin_geonames["geoJSON"] = [json.dumps(poly.__geo_interface__) for poly in admin_polygons]
-    admin_geonames = admin_geonames.filter(["geonameid", "geoJSON"])
-    admin_geonames = admin_geonames.rename_axis("geoNameId", axis = "rows")
-    admin_geonames.to_csv(filename, sep="\t")
+def task_of(table):
+    return tuple(table.column(col)[0].as_py() for col in ("country", "level", "lod"))
@@ -7,99 +7,185 @@ from pathlib import Path
 import requests
 import json
 import pickle
+import shutil
 from . import data
 from .download import geonames_file
+from .cache import CACHE_DIR, check_cache, source_signature
+from collections.abc import Mapping
 from pickle import dump, load
 from tqdm import tqdm
 
 
 DATA_DIR = Path(data.__file__).parent
-CACHE_DIR = Path(DATA_DIR, "cache")
-if not CACHE_DIR.exists():
-    CACHE_DIR.mkdir(parents=True)
-
-
-def check_cache(pickle_name):
-    def decorator(fn):
-        def decorated(*args, **kwargs):
-            pickle_path = Path(CACHE_DIR, pickle_name)
-            if pickle_path.exists():
-                with open(pickle_path, "rb") as f:
-                    print("Loading cached '{}'.".format(pickle_name))
-                    return pickle.load(f)
-            print("Building from original file.")
-            built_dataset = fn(*args, **kwargs)
-            with open(pickle_path, "wb") as f:
-                pickle.dump(built_dataset, f)
-            print("Saved '{}' to cache.".format(pickle_name))
-            return built_dataset
-        return decorated
-    return decorator
-
-
-def delete_cached(pickle_name):
-    pickle_path = Path(DATA_DIR, pickle_name)
-    pickle_path.unlink(missing_ok=True)
-
-
-# @check_cache("geonames.pickle")
-def geonames(include_points=True, include_admin5=False):
+SHARD_DIR = Path(CACHE_DIR, "shards")
+
+# The GeoNames columns that making Voronoms polygons needs.
+PROCESSING_COLUMNS = [
+    "latitude",
+    "longitude",
+    "feature_class",
+    "feature_code",
+    "country_code",
+    "admin1_code",
+    "admin2_code",
+    "admin3_code",
+    "admin4_code",
+    "modification_date",
+]
+
+
+# Low-cardinality string columns, stored as categoricals in compact mode.
+CATEGORICAL_COLUMNS = [
+    "feature_class",
+    "feature_code",
+    "country_code",
+    "cc2",
+    "admin1_code",
+    "admin2_code",
+    "admin3_code",
+    "admin4_code",
+    "timezone",
+]
+
+ADMIN_LEVELS = [1, 2, 3, 4]
+
+
+# The columns of allCountries.txt, which GeoNames's daily modifications files share.
+GEONAMES_COLUMNS = [
+    "geonameid",
+    "name",
+    "asciiname",
+    "alternatenames",
+    "latitude",
+    "longitude",
+    "feature_class",
+    "feature_code",
+    "country_code",
+    "cc2",
+    "admin1_code",
+    "admin2_code",
+    "admin3_code",
+    "admin4_code",
+    "population",
+    "elevation",
+    "dem",
+    "timezone",
+    "modification_date",
+]
+
+GEONAMES_COLUMN_TYPES = {
+    "geonameid": np.int64,
+    "name": str,
+    "asciiname": str,
+    "alternatenames": str,
+    "latitude": np.float64,
+    "longitude": np.float64,
+    "feature_class": str,
+    "feature_code": str,
+    "country_code": str,
+    "cc2": str,
+    "admin1_code": str,
+    "admin2_code": str,
+    "admin3_code": str,
+    "admin4_code": str,
+    "population": np.int64,
+    "elevation": np.float64,
+    "dem": np.int64,
+    "timezone": str,
+    "modification_date": object,
+}
+
+
+@check_cache("geonames", "allCountries.txt", "admin1CodesASCII.txt", "admin2Codes.txt")
+def geonames(
+    include_points=False,
+    include_admin5=False,
+    columns=None,
+    countries=None,
+    feature_classes=None,
+    chunksize=1000000,
+    compact=False,
+    float32=False,
+):
+    """
+    Loads the GeoNames table.
+
+    Coordinates are kept in the float64 `longitude` and `latitude` columns; pass
+    `include_points=True` to also get a column of shapely Points, which are built
+    in one vectorized call.
+
+    The file is read in chunks of `chunksize` rows, and only the rows and columns
+    asked for are kept from each chunk, so memory use follows the size of the
+    result rather than of the whole file.
+
+    Arguments:
+        columns: The columns to read, besides the `geonameid` index. All of them
+            by default; `PROCESSING_COLUMNS` holds the ones polygon-making needs.
+        countries: If given, only rows with these country codes are kept.
+        feature_classes: If given, only rows with these feature classes are kept.
+        compact: If True, low-cardinality string columns are stored as categoricals,
+            and an integer `admin{n}_key` column is added for each admin level (see
+            `admin_keys`), which `voronoms.process` filters on instead of strings.
+        float32: If True, coordinates are stored as float32.
+    """
     geonames_path = geonames_file("allCountries.txt")
-    col_names = [
-        "geonameid",
-        "name",
-        "asciiname",
-        "alternatenames",
-        "latitude",
-        "longitude",
-        "feature_class",
-        "feature_code",
-        "country_code",
-        "cc2",
-        "admin1_code",
-        "admin2_code",
-        "admin3_code",
-        "admin4_code",
-        "population",
-        "elevation",
-        "dem",
-        "timezone",
-        "modification_date",
+    geonames = read_geonames_table(geonames_path, columns, countries, feature_classes, chunksize)
+    return prepare_geonames(geonames, include_points, include_admin5, compact, float32)
+
+
+def read_geonames_table(path, columns=None, countries=None, feature_classes=None, chunksize=1000000):
+    """
+    Reads a file in the format of allCountries.txt, keeping only the columns and
+    rows asked for. See `geonames` for the arguments.
+    """
+    if columns is None:
+        columns = GEONAMES_COLUMNS[1:]
+    filter_cols = []
+    if countries is not None:
+        filter_cols.append("country_code")
+    if feature_classes is not None:
+        filter_cols.append("feature_class")
+    read_cols = ["geonameid"] + [
+        col for col in GEONAMES_COLUMNS[1:] if col in columns or col in filter_cols
     ]
-    col_types = {
-        "geonameid": np.int64,
-        "name": str,
-        "asciiname": str,
-        "alternatenames": str,
-        "latitude": np.float64,
-        "longitude": np.float64,
-        "feature_class": str,
-        "feature_code": str,
-        "country_code": str,
-        "cc2": str,
-        "admin1_code": str,
-        "admin2_code": str,
-        "admin3_code": str,
-        "admin4_code": str,
-        "population": np.int64,
-        "elevation": np.float64,
-        "dem": np.int64,
-        "timezone": str,
-        "modification_date": object,
-    }
-    geonames = pd.read_table(
-        geonames_path,
-        names=col_names,
-        dtype=col_types,
-        nrows=None,
+
+    chunks = []
+    reader = pd.read_table(
+        path,
+        names=GEONAMES_COLUMNS,
+        dtype={col: GEONAMES_COLUMN_TYPES[col] for col in read_cols},
+        usecols=read_cols,
         index_col="geonameid",
+        chunksize=chunksize,
     )
+    for chunk in reader:
+        if countries is not None:
+            chunk = chunk[chunk.country_code.isin(countries)]
+        if feature_classes is not None:
+            chunk = chunk[chunk.feature_class.isin(feature_classes)]
+        chunks.append(chunk.drop(columns=[col for col in filter_cols if col not in columns]))
+    return pd.concat(chunks)
+
+
+def prepare_geonames(geonames, include_points=False, include_admin5=False, compact=False, float32=False):
+    """
+    Adds the derived columns and dtypes that `geonames` is asked for to a table
+    read by `read_geonames_table`.
+    """
+    if compact:
+        for col in CATEGORICAL_COLUMNS:
+            if col in geonames.columns:
+                geonames[col] = geonames[col].astype("category")
+        if "country_code" in geonames.columns and "admin1_code" in geonames.columns:
+            for admin_level, keys in admin_keys(geonames).items():
+                geonames["admin{}_key".format(admin_level)] = keys
+    if float32:
+        for col in ["latitude", "longitude"]:
+            if col in geonames.columns:
+                geonames[col] = geonames[col].astype(np.float32)
 
     if include_points:
-        points = []
-        for coords in tqdm(zip(geonames.longitude, geonames.latitude), total=len(geonames)):
-            points.append(shapely.geometry.point.Point(coords))
-        geonames["points"] = points
+        geonames["points"] = shapely.points(geonames.longitude, geonames.latitude)
 
     if include_admin5:
         admin5_path = geonames_file("adminCode5.txt")
@@ -115,7 +201,179 @@ def geonames(include_points=True, include_admin5=False):
     return geonames
 
 
-@check_cache("admin2_codes.pickle")
+def admin_keys(geonames):
+    """
+    Encodes the admin path of each GeoName at each admin level as an integer.
+
+    A GeoName's admin path at a level is its country code and admin codes down to
+    that level, joined with dots, e.g. "US.NY.047" at level 2. This is the same form
+    as the codes in GeoNames's admin1 and admin2 code tables. The paths in those
+    tables are numbered first, in table order, and any other paths are numbered
+    after them. GeoNames missing any code down to the level get -1.
+
+    Returns a dictionary of int32 arrays keyed by admin level.
+    """
+    code_tables = {1: admin1_codes(), 2: admin2_codes()}
+    paths = geonames.country_code.astype(object)
+    missing = paths.isna().to_numpy()
+    keys = {}
+    for admin_level in ADMIN_LEVELS:
+        col = "admin{}_code".format(admin_level)
+        if col not in geonames.columns:
+            break
+        missing = missing | geonames[col].isna().to_numpy()
+        paths = paths + "." + geonames[col].astype(object)
+        known_paths = []
+        if admin_level in code_tables:
+            known_paths = code_tables[admin_level].concatenated_codes.drop_duplicates()
+        other_paths = pd.Index(paths[~missing].unique()).difference(known_paths)
+        categories = pd.Index(known_paths).append(other_paths)
+        level_keys = pd.Categorical(paths.where(~missing), categories=categories).codes
+        keys[admin_level] = level_keys.astype(np.int32)
+    return keys
+
+
+def geonames_by_country(geonames):
+    """
+    Splits the GeoNames table into one frame per country, keyed by country code.
+
+    The table is sorted by country once, and each country's frame is a slice of
+    it, so later lookups never have to scan the global table.
+    """
+    geonames = geonames[geonames.country_code.notna()]
+    order = np.argsort(geonames.country_code.to_numpy(dtype=str), kind="stable")
+    geonames = geonames.iloc[order]
+    country_codes, offsets = np.unique(geonames.country_code.to_numpy(dtype=str), return_index=True)
+    bounds = zip(offsets, list(offsets[1:]) + [len(geonames)])
+    return {
+        country_code: geonames.iloc[start:stop]
+        for country_code, (start, stop) in zip(country_codes, bounds)
+    }
+
+
+# Per-country shards
+#
+# A shard holds one country's GeoNames as a directory of .npy files, one per
+# column, which `geonames_shard` opens as memory maps. Any process can open any
+# country's shard without parsing or unpickling anything, and processes opening the
+# same shard share its pages.
+#
+# The shard directory records the signatures of the GeoNames files its shards
+# were written from, as the cache does, so that shards from an older dump are
+# rewritten rather than read.
+
+SHARD_COLUMNS = [
+    "longitude",
+    "latitude",
+    "feature_class",
+    "feature_code",
+    "admin1_key",
+    "admin2_key",
+    "admin3_key",
+    "admin4_key",
+    "modification_date",
+]
+
+SHARD_SOURCES = ["allCountries.txt", "admin1CodesASCII.txt", "admin2Codes.txt"]
+
+
+def shard_signature():
+    return "\n".join(source_signature(geonames_file(name)) for name in SHARD_SOURCES)
+
+
+def shards_current(shard_dir=SHARD_DIR):
+    """
+    Returns whether the shards in a directory were written from the GeoNames
+    files that are on disk now.
+    """
+    signature_path = Path(shard_dir, "source.txt")
+    return signature_path.exists() and signature_path.read_text() == shard_signature()
+
+
+def write_shards(geonames, shard_dir=SHARD_DIR, replace=False):
+    """
+    Writes a shard for each country in the GeoNames, which can be given as a table
+    or as the partition returned by `geonames_by_country`. Admin keys are added
+    first if the GeoNames weren't loaded in compact mode.
+
+    Arguments:
+        replace: If True, every existing shard is deleted first, so that
+            countries the GeoNames no longer have don't keep stale shards.
+    """
+    shard_dir = Path(shard_dir)
+    if replace and shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    if not isinstance(geonames, Mapping):
+        if "admin1_key" not in geonames.columns:
+            geonames = geonames.copy()
+            for admin_level, keys in admin_keys(geonames).items():
+                geonames["admin{}_key".format(admin_level)] = keys
+        geonames = geonames_by_country(geonames)
+    for country, country_geonames in tqdm(geonames.items(), total=len(geonames)):
+        country_dir = Path(shard_dir, country)
+        if not country_dir.exists():
+            country_dir.mkdir(parents=True)
+        np.save(Path(country_dir, "geonameid.npy"), country_geonames.index.to_numpy(np.int64))
+        for col in SHARD_COLUMNS:
+            if col not in country_geonames.columns:
+                continue
+            values = country_geonames[col]
+            if values.dtype.kind in "fi":
+                values = values.to_numpy()
+            else:
+                values = values.astype(object).fillna("").to_numpy(dtype=str)
+            np.save(Path(country_dir, "{}.npy".format(col)), values)
+    if not shard_dir.exists():
+        shard_dir.mkdir(parents=True)
+    Path(shard_dir, "source.txt").write_text(shard_signature())
+
+
+def geonames_shard(country, shard_dir=SHARD_DIR):
+    """
+    Opens a country's shard as a GeoNames frame. Numeric columns are memory maps
+    of the shard's files rather than copies.
+    """
+    country_dir = Path(shard_dir, country)
+    if not country_dir.exists():
+        raise KeyError("No shard for country '{}'.".format(country))
+    columns = {}
+    for col in SHARD_COLUMNS:
+        col_path = Path(country_dir, "{}.npy".format(col))
+        if col_path.exists():
+            columns[col] = np.load(col_path, mmap_mode="r")
+    geonameids = np.load(Path(country_dir, "geonameid.npy"), mmap_mode="r")
+    shard = pd.DataFrame(columns, index=pd.Index(geonameids, name="geonameid"), copy=False)
+    shard["country_code"] = country
+    return shard
+
+
+class GeonamesShards(Mapping):
+    """
+    The per-country shards in a directory, as a mapping from country code to
+    GeoNames frame that `voronoms.process` accepts in place of the partition
+    returned by `geonames_by_country`. Shards are opened when first asked for.
+    """
+
+    def __init__(self, shard_dir=SHARD_DIR):
+        self.shard_dir = Path(shard_dir)
+        self.countries = sorted(
+            path.name for path in self.shard_dir.iterdir() if path.is_dir()
+        ) if self.shard_dir.exists() else []
+        self.opened = {}
+
+    def __getitem__(self, country):
+        if country not in self.opened:
+            self.opened[country] = geonames_shard(country, self.shard_dir)
+        return self.opened[country]
+
+    def __iter__(self):
+        return iter(self.countries)
+
+    def __len__(self):
+        return len(self.countries)
+
+
+@check_cache("admin2_codes", "admin2Codes.txt")
 def admin2_codes():
     admin2_codes_path = geonames_file("admin2Codes.txt")
     col_names = ["concatenated_codes", "name", "asciiname", "geonameid"]
@@ -131,7 +389,7 @@ def admin2_codes():
     return admin2_codes
 
 
-@check_cache("admin1_codes.pickle")
+@check_cache("admin1_codes", "admin1CodesASCII.txt")
 def admin1_codes():
     admin1_codes_path = geonames_file("admin1CodesASCII.txt")
     col_names = ["concatenated_codes", "name", "asciiname", "geonameid"]
@@ -147,7 +405,7 @@ def admin1_codes():
     return admin1_codes
 
 
-@check_cache("hierarchy.pickle")
+@check_cache("hierarchy", "hierarchy.txt")
 def hierarchy():
     hierarchy_path = geonames_file("hierarchy.txt")
     col_names = ["parent", "child", "type"]
@@ -157,7 +415,7 @@ def hierarchy():
     return hierarchy
 
 
-@check_cache("shapes.pickle")
+@check_cache("shapes", "shapes_all_low.txt")
 def shapes():
     shapes_file = geonames_file("shapes_all_low.txt")
     col_names = ["geonameid", "geojson"]
@@ -171,7 +429,7 @@ def shapes():
     return shapes
 
 
-@check_cache("world_geometry.pickle")
+@check_cache("world_geometry", "shapes_all_low.txt")
 def world_geometry():
     print("Joining world geometry. This takes a few minutes.")
     geometry = list(shapes().geometry)
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import shapely
+from pathlib import Path
+
+
+"""
+This module keeps a build manifest of what each country and admin level was
+made from, so that a later run only rebuilds what has changed.
+"""
+
+
+def read_manifest(path):
+    path = Path(path)
+    if not path.exists():
+        return {"countries": {}, "tasks": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, path):
+    """
+    Writes the manifest through a temporary file, so it's never left half-written.
+    """
+    path = Path(path)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def country_fingerprint(country_geonames, outline=None, sources=(), patched=None):
+    """
+    Fingerprints a country by its GeoNames, outline, source files and deltas.
+    """
+    modified = ""
+    if "modification_date" in country_geonames.columns and len(country_geonames) > 0:
+        modified = str(country_geonames.modification_date.astype(str).max())
+    fingerprint = {"rows": int(len(country_geonames)), "modified": modified}
+    fingerprint["outline"] = hashlib.sha1(shapely.to_wkb(outline)).hexdigest() if outline is not None else ""
+    fingerprint["sources"] = list(sources)
+    if patched is not None:
+        fingerprint["patched"] = patched
+    return fingerprint
+
+
+def params_digest(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def task_digest(admin_geonames, voronoi_geonames, context_geonameids, outline, params):
+    """
+    Digests the inputs to one country and admin level. `context_geonameids` are
+    the ids of every point in the tessellation the polygons are cut from.
+    """
+    admin_code_cols = [col for col in admin_geonames.columns if col.startswith("admin")]
+    digest = hashlib.sha1()
+    digest.update(hash_frame(admin_geonames[admin_code_cols]))
+    digest.update(hash_frame(voronoi_geonames[["longitude", "latitude"] + admin_code_cols]))
+    digest.update(np.sort(np.asarray(context_geonameids, dtype=np.int64)).tobytes())
+    digest.update(shapely.to_wkb(outline))
+    digest.update(params_digest(params).encode())
+    return digest.hexdigest()
+
+
+def hash_frame(frame):
+    # Categorical and string columns are hashed by value, so that the digest doesn't
+    # depend on how categories happen to be numbered.
+    frame = frame.apply(lambda col: col if col.dtype.kind in "fiu" else col.astype(object))
+    return pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes()
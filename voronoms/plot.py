@@ -1,61 +1,127 @@
 import matplotlib.pyplot as plt
-from descartes import PolygonPatch
+import numpy as np
+import shapely
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.patches import PathPatch
+from matplotlib.figure import Figure
+from matplotlib.path import Path
 from . import colormap
+from .topology import select_lod
+
+
+"""
+This module plots Voronoms polygons with matplotlib.
+"""
 
 
 def polygon(poly, name=None):
     fig = plt.figure(figsize=(6, 6), dpi=300)
     ax = fig.add_subplot(111)
     ax.axis("equal")
-    ax.add_patch(PolygonPatch(poly))
+    for path in polygon_paths([poly])[0]:
+        ax.add_patch(PathPatch(path))
     ax.autoscale()
     if name is not None:
         ax.set_title(name)
     plt.show()
 
 
-def polygons(polys, name=None, xlim=None, ylim=None, figsize=(12, 12), dpi=300):
-    colors = colormap.rescale_and_interpolate(
-        colormap.turbo_colormap_data, range(0, len(polys))
-    )
+def polygons(polys, name=None, xlim=None, ylim=None, figsize=(12, 12), dpi=300, lod=None):
     fig = plt.figure(figsize=figsize, dpi=dpi)
+    draw_polygons(fig, select_lod(polys, lod), name, xlim, ylim)
+    return fig
+
+
+def save_polygons(polys, filename, name=None, xlim=None, ylim=None, figsize=(12, 12), dpi=300, lod=None):
+    """
+    Plots polygons as `polygons` does and saves the plot, without using pyplot.
+    """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    draw_polygons(fig, select_lod(polys, lod), name, xlim, ylim)
+    fig.savefig(filename)
+
+
+def draw_polygons(fig, polys, name=None, xlim=None, ylim=None):
+    colors = colormap.turbo.rescale_and_interpolate(np.arange(len(polys)))
+    paths, present = polygon_paths(polys)
     ax = fig.add_subplot(1, 1, 1)
     ax.axis("equal")
-    for i, (poly, color) in enumerate(zip(polys, colors)):
-        try:
-            ax.add_patch(PolygonPatch(poly, facecolor=color, linewidth=0.1))
-        except ValueError as e:
-            continue
+    collection = PathCollection(
+        paths, facecolors=colors[present], edgecolors="none", linewidths=0.1
+    )
+    ax.add_collection(collection, autolim=True)
     ax.autoscale()
     ax.set_title(name)
     if xlim is not None:
         ax.set_xlim(xlim)
     if ylim is not None:
         ax.set_ylim(ylim)
-    return fig
 
 
-def polygon_subplots(polys, names=None, columns=2, figsize=(12, 24), dpi=300):
+def polygon_paths(polys):
+    """
+    Converts polygons into matplotlib paths, one per polygon, and returns them
+    with a mask of the polygons that weren't missing or empty.
+    """
+    polys = np.asarray(polys, dtype=object)
+    present = ~shapely.is_missing(polys)
+    present[present] = ~shapely.is_empty(polys[present])
+    polys = polys[present]
+    if not len(polys):
+        return [], present
+
+    parts, part_index = shapely.get_parts(polys, return_index=True)
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    vertices, vertex_index = shapely.get_coordinates(rings, return_index=True)
+
+    # Reverse the rings that run the wrong way. Each part's exterior comes first.
+    is_exterior = np.r_[True, ring_index[1:] != ring_index[:-1]]
+    flip = shapely.is_ccw(rings) != is_exterior
+    starts = np.flatnonzero(np.r_[True, vertex_index[1:] != vertex_index[:-1]])
+    ends = np.r_[starts[1:], len(vertices)]
+    order = np.arange(len(vertices))
+    flipped = flip[vertex_index]
+    ring_of = vertex_index[flipped]
+    order[flipped] = starts[ring_of] + ends[ring_of] - 1 - order[flipped]
+    vertices = vertices[order]
+
+    # Each ring starts with a MOVETO and ends with a CLOSEPOLY, whose vertex is
+    # ignored.
+    codes = np.full(len(vertices), Path.LINETO, dtype=Path.code_type)
+    codes[starts] = Path.MOVETO
+    codes[ends - 1] = Path.CLOSEPOLY
+
+    polygon_of_vertex = part_index[ring_index[vertex_index]]
+    splits = np.searchsorted(polygon_of_vertex, np.arange(1, len(polys)))
+    paths = [
+        Path(polygon_vertices, polygon_codes)
+        for polygon_vertices, polygon_codes in zip(np.split(vertices, splits), np.split(codes, splits))
+    ]
+    return paths, present
+
+
+def polygon_subplots(polys, names=None, columns=2, figsize=(12, 24), dpi=300, lod=None):
+    polys = select_lod(polys, lod)
     if names is None:
         names = range(len(polys))
-    colors = colormap.rescale_and_interpolate(
-        colormap.turbo_colormap_data, range(0, len(polys))
-    )
+    colors = colormap.turbo.rescale_and_interpolate(np.arange(len(polys)))
     fig = plt.figure(figsize=figsize, dpi=dpi)
     rows = len(polys) // columns
     if len(polys) % columns != 0:
         rows += 1
-    for i, (poly, name, color) in enumerate(zip(polys, names, colors)):
-        try:
-            ax = fig.add_subplot(rows, columns, i + 1)
-            ax.axis("equal")
-            ax.add_patch(PolygonPatch(poly, facecolor=color, linewidth=0.1))
-            ax.autoscale()
-            ax.set_title(name)
-            ax.set_xticks([])
-            ax.set_yticks([])
-        except ValueError as e:
-            continue
+    paths, present = polygon_paths(polys)
+    paths = iter(paths)
+    for i, (is_present, name, color) in enumerate(zip(present, names, colors)):
+        ax = fig.add_subplot(rows, columns, i + 1)
+        ax.axis("equal")
+        if is_present:
+            ax.add_patch(PathPatch(next(paths), facecolor=color, linewidth=0.1))
+        ax.autoscale()
+        ax.set_title(name)
+        ax.set_xticks([])
+        ax.set_yticks([])
     plt.show()
 
 
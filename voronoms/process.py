@@ -1,40 +1,233 @@
 import pandas as pd
 import numpy as np
-from scipy.spatial import Voronoi
+import shapely
+from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import Voronoi, cKDTree
 from shapely.geometry import Polygon, MultiPolygon
 from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from tqdm import tqdm #TODO: make this conditional on verbose option
+from .dissolve import dissolve_voronoi
+from .statistics import geodesic_areas
 
 
-def make_admin_polygons(country, admin_level, geonames, shapes, clean=None):
+def make_admin_polygons(
+    country, admin_level, geonames, shapes, clean=None, tessellation=None, engine="union",
+    workers=None,
+):
+    """
+    Makes a polygon for each admin area of a country's admin level.
+
+    `engine` picks how Voronoi cells are merged: "union" builds a polygon per cell
+    and unions them, while "ridges" traces the area outlines straight from the
+    diagram's ridges (see `voronoms.dissolve`).
+
+    If `workers` is more than 1, the admin areas are merged in a thread pool of
+    that size. Shapely's geometry operations release the GIL, so the areas are
+    merged in parallel. The polygons come back in the order of the admin GeoNames
+    either way.
+    """
+    if tessellation is not None:
+        return make_admin_polygons_from_tessellation(
+            tessellation, admin_level, clean=clean, engine=engine, workers=workers
+        )
+
+    geonames = get_country_geonames(country, geonames)
     admin_geonames = get_admin_geonames(country, admin_level, geonames)
-    voronoi_geonames = get_voronoi_geonames(country, admin_level, geonames)
+    voronoi_geonames = get_voronoi_geonames(country, admin_level, geonames, admin_geonames)
 
     # Get the outline for the country we're handling
-    shapes["country_code"] = geonames.loc[shapes.index, "country_code"]
-    country_outline = shapes.query("country_code == '{}'".format(country)).iloc[0][
-        "geometry"
-    ]
+    country_outline = get_country_outline(country, geonames, shapes)
 
     # Draw the Voronoi diagram
     print("Creating Voronoi diagram...")
-    country_voronoi = Voronoi([x.coords[0] for x in voronoi_geonames.points])
+    country_voronoi = Voronoi(get_coordinates(voronoi_geonames))
+
+    # Group the Voronoi points by admin area once, so each area's lookup is a
+    # dictionary hit rather than a query over the whole table.
+    point_index = index_voronoi_points(admin_level, voronoi_geonames)
+
+    admin_point_indices = [
+        get_admin_point_indices(admin_geoname, admin_level, point_index, voronoi_geonames)
+        for geonameid, admin_geoname in admin_geonames.iterrows()
+    ]
 
     # Polygon-generating loop
-    admin_polygons = []
     print("Generating polygons...")
-    for geonameid, admin_geoname in tqdm(admin_geonames.iterrows(), total=len(admin_geonames)):
-        admin_polygons.append(
-            extract_polygon_from_voronoi(
-                admin_geoname, geonames, voronoi_geonames, country_voronoi, country_outline
-            )
+    if engine == "ridges":
+        admin_labels = np.full(len(voronoi_geonames), -1)
+        for i, point_indices in enumerate(admin_point_indices):
+            admin_labels[point_indices] = i
+        admin_polygons = dissolve_and_clip(
+            country_voronoi, admin_labels, len(admin_geonames), country_outline, workers
         )
+    else:
+        admin_polygons = map_admin_areas(
+            lambda point_indices: extract_polygon_from_voronoi(
+                point_indices, country_voronoi, country_outline
+            ),
+            admin_point_indices,
+            workers,
+        )
+
+    return clean_polygons(admin_polygons, clean)
+
+
+def make_admin_polygons_from_tessellation(
+    tessellation, admin_level, clean=None, engine="union", workers=None
+):
+    """
+    Makes the polygons for one admin level of a country from a tessellation that
+    was drawn once for all of the country's admin levels.
+    """
+    admin_cell_indices = get_admin_cell_indices(tessellation, admin_level)
+    print("Generating polygons...")
+    if engine == "ridges":
+        admin_labels = np.full(len(tessellation.geonames), -1)
+        for i, cell_indices in enumerate(admin_cell_indices):
+            admin_labels[cell_indices] = i
+        admin_polygons = dissolve_and_clip(
+            tessellation.voronoi, admin_labels, len(admin_cell_indices), tessellation.outline,
+            workers,
+        )
+    else:
+        admin_polygons = map_admin_areas(
+            lambda cell_indices: union_cells(tessellation, cell_indices),
+            admin_cell_indices,
+            workers,
+        )
+
+    return clean_polygons(admin_polygons, clean)
+
+
+def make_hierarchical_admin_polygons(tessellation, clean=None, workers=None):
+    """
+    Makes the polygons for all of a tessellation's admin levels from the bottom up.
+
+    The finest level is dissolved from Voronoi cells. Each coarser admin area is then
+    dissolved from the already-merged polygons of its child areas one level down, plus
+    the cells of any of its points that don't belong to a child area, such as points
+    with no code at the finer level. This gives the same shapes as dissolving each level
+    from cells, but each union only has to merge a handful of pieces.
+
+    Returns a dictionary of admin polygons keyed by admin level. Levels with no points
+    to draw from are left out.
+    """
+    admin_levels = [
+        admin_level for admin_level in sorted(tessellation.admin_geonames, reverse=True)
+        if len(tessellation.voronoi_geonames[admin_level]) > 0
+    ]
+    raw_polygons = {}
+    child_level = None
+    for admin_level in admin_levels:
+        print("Generating polygons for admin level {}...".format(admin_level))
+        admin_cell_indices = get_admin_cell_indices(tessellation, admin_level)
+
+        # Group the finer level's areas under the admin codes they share with this level.
+        children = defaultdict(list)
+        if child_level is not None:
+            child_geonames = tessellation.admin_geonames[child_level]
+            child_keys = zip(*[child_geonames[col] for col in admin_cols(admin_level, child_geonames)])
+            for i, child_key in enumerate(child_keys):
+                children[child_key].append(i)
+
+        def dissolve_area(admin_area):
+            admin_key, cell_indices = admin_area
+            remaining = set(cell_indices)
+            pieces = []
+            for child in children.get(admin_key, []):
+                child_cells = child_cell_indices[child]
+                # A child only stands in for its cells if they all belong to this area.
+                if len(child_cells) > 0 and remaining.issuperset(child_cells):
+                    remaining.difference_update(child_cells)
+                    pieces.append(raw_polygons[child_level][child])
+            pieces.extend(tessellation.cells[i] for i in sorted(remaining) if tessellation.cells[i] is not None)
+            unified = unary_union(pieces)
+            if type(unified) is Polygon:
+                unified = MultiPolygon([unified])
+            return unified
+
+        admin_geonames = tessellation.admin_geonames[admin_level]
+        admin_keys = zip(*[admin_geonames[col] for col in admin_cols(admin_level, admin_geonames)])
+        raw_polygons[admin_level] = map_admin_areas(
+            dissolve_area, list(zip(admin_keys, admin_cell_indices)), workers
+        )
+        child_level = admin_level
+        child_cell_indices = admin_cell_indices
+
+    return {
+        admin_level: clean_polygons(admin_polygons, clean)
+        for admin_level, admin_polygons in sorted(raw_polygons.items())
+    }
 
+
+def get_admin_cell_indices(tessellation, admin_level):
+    """
+    Returns the positions of the tessellation's cells that make up each admin area
+    in the level, in the same order as the level's admin GeoNames.
+    """
+    admin_geonames = tessellation.admin_geonames[admin_level]
+    voronoi_geonames = tessellation.voronoi_geonames[admin_level]
+    if len(voronoi_geonames) == 0:
+        raise ValueError("No GeoNames with codes at admin level {}".format(admin_level))
+    members = tessellation.cell_members(admin_level)
+    positions = tessellation.positions[admin_level]
+    point_index = index_voronoi_points(admin_level, voronoi_geonames)
+
+    admin_cell_indices = []
+    for geonameid, admin_geoname in admin_geonames.iterrows():
+        point_indices = get_admin_point_indices(
+            admin_geoname, admin_level, point_index, voronoi_geonames
+        )
+        admin_cell_indices.append([
+            i for point_idx in positions[point_indices] for i in members.get(point_idx, [])
+        ])
+    return admin_cell_indices
+
+
+def map_admin_areas(fn, admin_areas, workers=None):
+    """
+    Applies `fn` to each admin area, in a thread pool if `workers` is more than 1,
+    and returns the results in order.
+    """
+    if workers is None or workers <= 1:
+        return [fn(admin_area) for admin_area in tqdm(admin_areas)]
+    with ThreadPoolExecutor(workers) as executor:
+        return list(tqdm(executor.map(fn, admin_areas), total=len(admin_areas)))
+
+
+def dissolve_and_clip(voronoi, admin_labels, n_admin, country_outline, workers=None):
+    def clip(admin_polygon):
+        admin_polygon = admin_polygon.intersection(country_outline)
+        if type(admin_polygon) is Polygon:
+            admin_polygon = MultiPolygon([admin_polygon])
+        return admin_polygon
+
+    return map_admin_areas(clip, dissolve_voronoi(voronoi, admin_labels, n_admin), workers)
+
+
+def union_cells(tessellation, cell_indices):
+    admin_cells = [
+        tessellation.cells[i] for i in cell_indices if tessellation.cells[i] is not None
+    ]
+    unified_cells = unary_union(admin_cells)
+    if type(unified_cells) is Polygon:
+        unified_cells = MultiPolygon([unified_cells])
+    return unified_cells
+
+
+def clean_polygons(admin_polygons, clean=None):
     if clean is None or clean == "none":
         pass
     elif clean == "cutoff":
         print("Cleaning polygons...")
         admin_polygons = clean_polygons_max_diff_cutoff(admin_polygons)
+    elif clean == "geodesic-cutoff":
+        print("Cleaning polygons...")
+        admin_polygons = clean_polygons_max_diff_cutoff(admin_polygons, geodesic=True)
     elif clean == "simple":
         print("Cleaning polygons...")
         admin_polygons = clean_polygons_simple(admin_polygons)
@@ -42,58 +235,134 @@ def make_admin_polygons(country, admin_level, geonames, shapes, clean=None):
     return admin_polygons
 
 
-def admin_cols(admin_level=None):
+def admin_cols(admin_level=None, geonames=None):
+    """
+    Returns the columns that identify an admin area at a level. If the GeoNames
+    were loaded in compact mode, this is the level's integer admin key; otherwise
+    it is the admin codes down to the level.
+    """
+    if geonames is not None and admin_key_col(admin_level) in geonames:
+        return [admin_key_col(admin_level)]
     return ["admin{}_code".format(i) for i in range(1, admin_level + 1)]
 
 
+def admin_key_col(admin_level):
+    return "admin{}_key".format(admin_level)
+
+
+def get_country_geonames(country, geonames):
+    """
+    This function returns the GeoNames in a country. The GeoNames can be given as
+    the full table, as the partition returned by `load.geonames_by_country`, or
+    as a frame that already holds only the country.
+    """
+    if isinstance(geonames, Mapping):
+        return geonames[country]
+    return geonames[geonames.country_code.to_numpy() == country]
+
+
+def get_coordinates(geonames):
+    """
+    This function returns the longitude and latitude of GeoNames as a contiguous
+    (N, 2) float64 array, ready to hand to `scipy.spatial`.
+    """
+    return np.column_stack(
+        [geonames.longitude.to_numpy(np.float64), geonames.latitude.to_numpy(np.float64)]
+    )
+
+
+def get_country_outline(country, geonames, shapes):
+    """
+    This function returns the GeoNames outline of a country.
+    """
+    geonames = get_country_geonames(country, geonames)
+    outline_geonameids = shapes.index.intersection(geonames.index)
+    return shapes.loc[outline_geonameids].iloc[0]["geometry"]
+
+
 def get_admin_geonames(country, admin_level, geonames):
     """
     This function returns the GeoNames from a specified admin level in a country.
     """
+    geonames = get_country_geonames(country, geonames)
 
     # Get the admin geonames we'll be finding polygons for.
-    admin_predicate = "country_code == '{}' & feature_class == 'A' & feature_code == 'ADM{}'".format(
-        country, admin_level
-    )
-
-    admin_geonameids = (
-        geonames.query(admin_predicate).loc[:, admin_cols(admin_level)].drop_duplicates().dropna()
-    ).index
-    admin_geonames = geonames.loc[admin_geonameids]
+    is_admin = (
+        (geonames.feature_class == "A") & (geonames.feature_code == "ADM{}".format(admin_level))
+    ).to_numpy()
+    admin_codes = geonames.loc[is_admin, admin_cols(admin_level, geonames)]
+    if admin_key_col(admin_level) in admin_codes:
+        admin_codes = admin_codes[admin_codes[admin_key_col(admin_level)] >= 0].drop_duplicates()
+    else:
+        admin_codes = admin_codes.drop_duplicates().dropna()
+    admin_geonames = geonames.loc[admin_codes.index]
     return admin_geonames
 
 
-def get_voronoi_geonames(country, admin_level, geonames):
+def get_voronoi_geonames(country, admin_level, geonames, admin_geonames=None):
     """
     This function returns all GeoNames which have an admin code at the specified level, and
     thus can be used to make inferences about the admin area shapes.
-    """
-    # TODO: This is super inefficient.
-    admin_geonames = get_admin_geonames(country, admin_level, geonames)
-    voronoi_predicate_parts = ["country_code == '{}'".format(country)]
-    for col in admin_cols(admin_level):
-        voronoi_predicate_parts.append("{} in @admin_geonames.{}".format(col, col))
-    voronoi_predicate = " & ".join(voronoi_predicate_parts)
 
-    voronoi_geonames = geonames.query(voronoi_predicate)
+    If the admin GeoNames for the country and level have already been found, they can be
+    passed in to save looking them up again.
+    """
+    geonames = get_country_geonames(country, geonames)
+    if admin_geonames is None:
+        admin_geonames = get_admin_geonames(country, admin_level, geonames)
+    is_voronoi = np.ones(len(geonames), dtype=bool)
+    for col in admin_cols(admin_level, geonames):
+        is_voronoi &= geonames[col].isin(admin_geonames[col]).to_numpy()
+
+    voronoi_geonames = geonames[is_voronoi]
     return voronoi_geonames
 
 
-def extract_polygon_from_voronoi(admin_geoname, geonames, voronoi_geonames, country_voronoi, country_outline):
-    # Get the indices of the voronoi regions in this admin area
-    admin_col_names = [col for col in admin_geoname.index if "admin" in col]
-    polygon_predicate_parts = ["country_code == '{}'".format(admin_geoname.country_code)]
-    for col in admin_col_names:
-        if not pd.isnull(admin_geoname[col]):
-            polygon_predicate_parts.append("{} == '{}'".format(col, admin_geoname[col]))
-    polygon_predicate = " & ".join(polygon_predicate_parts)
-    polygon_geonames = geonames.query(polygon_predicate)
-    polygon_geonameids = polygon_geonames.index
+def index_voronoi_points(admin_level, voronoi_geonames):
+    """
+    This function groups the Voronoi points by their admin codes, returning a
+    dictionary from each tuple of admin codes to the positions of the points
+    carrying it.
+    """
+    columns = [voronoi_geonames[col] for col in admin_cols(admin_level, voronoi_geonames)]
+    point_index = defaultdict(list)
+    for i, admin_key in enumerate(zip(*columns)):
+        point_index[admin_key].append(i)
+    return point_index
+
+
+def get_admin_point_indices(admin_geoname, admin_level, point_index, voronoi_geonames):
+    """
+    This function returns the positions of the Voronoi points that fall in an
+    admin area, i.e. those sharing every admin code the admin geoname has.
+    """
+    level_cols = admin_cols(admin_level, voronoi_geonames)
+    admin_key = tuple(admin_geoname[col] for col in level_cols)
+    point_indices = np.array(point_index.get(admin_key, []), dtype=np.int64)
+
+    # Admin geonames occasionally carry codes below their own level, which the
+    # points have to match as well.
+    if admin_key_col(admin_level) in level_cols:
+        finer_cols = [
+            col for col in admin_geoname.index
+            if col.startswith("admin") and col.endswith("_key")
+            and int(col[5:-4]) > admin_level and admin_geoname[col] >= 0
+        ]
+    else:
+        finer_cols = [
+            col for col in admin_geoname.index
+            if "admin" in col and col not in level_cols and not pd.isnull(admin_geoname[col])
+        ]
+    for col in finer_cols:
+        matches = voronoi_geonames[col].to_numpy()[point_indices] == admin_geoname[col]
+        point_indices = point_indices[matches]
+    return point_indices
 
+
+def extract_polygon_from_voronoi(point_indices, country_voronoi, country_outline):
     # Figure out which Voronoi regions we need.
     # The Voronoi module calls them "regions" but I'm calling them
     # "cells" for clarity's sake.
-    point_indices = np.where(voronoi_geonames.index.isin(polygon_geonameids))[0]
     cell_indices = country_voronoi.point_region[point_indices]
 
     # Get the points for the regions and make them into Polygons
@@ -113,7 +382,98 @@ def extract_polygon_from_voronoi(admin_geoname, geonames, voronoi_geonames, coun
     return unified_cells
 
 
+# Tessellation shared between admin levels
+
+class Tessellation:
+    """
+    A Voronoi tessellation of a country, drawn once and shared by all of its admin levels.
+
+    The tessellation is drawn over every point that takes part in any of the admin
+    levels. For each level, a mask picks out the points that take part in it. Cells of
+    points that don't take part in a level are handed to the nearest point that does,
+    which approximates the Voronoi diagram of that level's points alone.
+
+    Attributes:
+        voronoi: The `scipy.spatial.Voronoi` diagram of the points.
+        point_region: The index of each point's cell in `voronoi.regions`.
+        cells: Each point's cell clipped to the country outline, or `None` for
+            cells that are unbounded or fall outside the outline.
+        admin_geonames, voronoi_geonames: The admin and Voronoi GeoNames for each level.
+        masks: A boolean mask over the points for each level.
+        positions: The positions of each level's Voronoi GeoNames among the points.
+    """
+
+    def __init__(self, country, geonames, shapes, admin_levels=(1, 2, 3)):
+        geonames = get_country_geonames(country, geonames)
+        self.country = country
+        self.admin_geonames = {}
+        self.voronoi_geonames = {}
+        level_masks = {}
+        for admin_level in admin_levels:
+            admin_geonames = get_admin_geonames(country, admin_level, geonames)
+            voronoi_geonames = get_voronoi_geonames(country, admin_level, geonames, admin_geonames)
+            self.admin_geonames[admin_level] = admin_geonames
+            self.voronoi_geonames[admin_level] = voronoi_geonames
+            level_masks[admin_level] = geonames.index.isin(voronoi_geonames.index)
+
+        # The union of the points needed by every level, in table order.
+        in_any_level = np.logical_or.reduce(list(level_masks.values()))
+        self.geonames = geonames[in_any_level]
+        self.masks = {level: mask[in_any_level] for level, mask in level_masks.items()}
+        self.positions = {level: np.flatnonzero(mask) for level, mask in self.masks.items()}
+        self.outline = get_country_outline(country, geonames, shapes)
+
+        print("Creating Voronoi diagram...")
+        self.coordinates = get_coordinates(self.geonames)
+        self.voronoi = Voronoi(self.coordinates)
+        self.point_region = self.voronoi.point_region
+
+        print("Clipping cells to country outline...")
+        prepared_outline = prep(self.outline)
+        self.cells = []
+        for cell_idx in tqdm(self.point_region):
+            vert_indices = self.voronoi.regions[cell_idx]
+            if -1 in vert_indices or len(vert_indices) == 0:
+                self.cells.append(None)
+                continue
+            cell = Polygon(self.voronoi.vertices[vert_indices])
+            if not prepared_outline.contains(cell):
+                cell = cell.intersection(self.outline)
+            self.cells.append(None if cell.is_empty else cell)
+
+        self._members = {}
+
+    def cell_members(self, admin_level):
+        """
+        Returns a dictionary mapping the position of each of the level's points to
+        the positions of the points whose cells it takes over at that level.
+        """
+        if admin_level not in self._members:
+            positions = self.positions[admin_level]
+            owners = np.arange(len(self.geonames))
+            others = np.flatnonzero(~self.masks[admin_level])
+            if len(others) > 0 and len(positions) > 0:
+                tree = cKDTree(self.coordinates[positions])
+                _, nearest = tree.query(self.coordinates[others])
+                owners[others] = positions[nearest]
+            elif len(positions) == 0:
+                owners[others] = -1
+            order = np.argsort(owners, kind="stable")
+            owner_values, starts = np.unique(owners[order], return_index=True)
+            self._members[admin_level] = {
+                owner: members
+                for owner, members in zip(owner_values, np.split(order, starts[1:]))
+                if owner >= 0
+            }
+        return self._members[admin_level]
+
+
 # Cleaning functions
+#
+# Each cleaning function tests the parts of every admin area against the parts of
+# every other area. The tests go through an STRtree of the parts, which only hands
+# back parts whose bounding boxes overlap and runs the predicate on a prepared copy
+# of the query geometry.
 
 def clean_polygons_simple(admin_polygons):
     """
@@ -121,50 +481,34 @@ def clean_polygons_simple(admin_polygons):
     contained within another admin area in the country.
     """
     # Fill in holes in the polygons
-    filled_admin_polygons = []
-    for admin_polygon in admin_polygons:
-        filled_poly = [
-            Polygon(poly.exterior) for poly in admin_polygon
-        ]
-        filled_admin_polygons.append(MultiPolygon(filled_poly))
+    filled_admin_polygons = fill_holes(admin_polygons)
 
     # Remove any polygons that are contained inside the now-filled polygons
-    cleaned_admin_polygons = []
-    for this_area in tqdm(filled_admin_polygons):
-        # Make a flat list of subpolygons of other admin regions
-        other_polys = []
-        for other_area in (filled_admin_polygons):
-            if other_area is not this_area:
-                for poly in other_area:
-                    other_polys.append(poly)
-
-        not_within_others = []
-        for poly in this_area:
-            if not any([poly.within(other_poly) for other_poly in other_polys]):
-                not_within_others.append(poly)
-        new_area = MultiPolygon(not_within_others)
-        cleaned_admin_polygons.append(new_area)
-    return cleaned_admin_polygons
-
-
-def clean_polygons_max_diff_cutoff(admin_polygons):
+    polys, area_ids = flatten_parts(filled_admin_polygons)
+    within_others = find_within_other_areas(polys, area_ids, STRtree(polys), area_ids)
+
+    cleaned_admin_polygons = [[] for area in filled_admin_polygons]
+    for poly, area_id, within in zip(polys, area_ids, within_others):
+        if not within:
+            cleaned_admin_polygons[area_id].append(poly)
+    return [MultiPolygon(area) for area in cleaned_admin_polygons]
+
+
+def clean_polygons_max_diff_cutoff(admin_polygons, geodesic=False):
     """
     Separates polygons in each admin area into "must keep" and "can delete" bins based on the largest cutoff of differences between sizes. "Can delete" polygons will be deleted if they are contained by another admin area. "Must keep" polygons will be kept, and will cut out holes in admin areas that contain them.
 
     This should work better for single-area admin areas which are entirely contained in other regions.
 
     It will likely fail for admin areas with no clear cutoff, or with multiple groups of sizes. More complex heuristics, such as k-means clustering, or an analysis of the entire group of admin areas to determine the best route, are probably a good aim for the next version.
+
+    Sizes are compared by planar area in square degrees, which shrinks toward the poles, unless `geodesic` is True, in which case they're compared by geodesic area.
     """
     # Fill in holes in the polygons
-    filled_polygons = []
-    for admin_polygon in admin_polygons:
-        filled_poly = [
-            Polygon(poly.exterior) for poly in admin_polygon
-        ]
-        filled_polygons.append(MultiPolygon(filled_poly))
+    filled_polygons = fill_holes(admin_polygons)
 
     # Separate polygons per region into "must keep" and "can delete". 
-    separated_polygons = [separate_deletion_candidates(p) for p in filled_polygons]
+    separated_polygons = [separate_deletion_candidates(p, geodesic) for p in filled_polygons]
     must_keep = [x[0] for x in separated_polygons]
     can_delete = [x[1] for x in separated_polygons]
 
@@ -172,59 +516,97 @@ def clean_polygons_max_diff_cutoff(admin_polygons):
     # each one to each other polygon we have to keep. If it contains another
     # must-keep polygon, we'll cut that out from it. Then we'll add the
     # resulting shape to our new list.
-    cleaned_polygons = []
-    for this_area in tqdm(must_keep):
-        other_polys = []
-        for other_area in must_keep:
-            if other_area is not this_area:
-                for poly in other_area:
-                    other_polys.append(poly)
-        new_area = []
-        for a in this_area:
-            for b in other_polys:
-                if a.contains(b):
-                    a = a.difference(b)
-            new_area.append(a)
-        cleaned_polygons.append(new_area)
+    keep_polys, keep_area_ids = flatten_parts(must_keep)
+    keep_tree = STRtree(keep_polys)
+    cleaned_polygons = [[] for area in must_keep]
+    for a, area_id in tqdm(zip(keep_polys, keep_area_ids), total=len(keep_polys)):
+        # Parts contained by the shrinking polygon are always contained by the
+        # original one, so those are the only ones worth testing, in their
+        # original order.
+        changed = False
+        for b_idx in np.sort(keep_tree.query(a, predicate="contains")):
+            if keep_area_ids[b_idx] == area_id:
+                continue
+            b = keep_polys[b_idx]
+            if not changed or a.contains(b):
+                a = a.difference(b)
+                changed = True
+        cleaned_polygons[area_id].append(a)
 
     # Next we'll operate on the polys which we can delete if they're contained.
     # This will operate in two stages.
 
     # first, deleting any which are contained in a must-keep area.
-    first_pass_kept = []
-    for this_area in tqdm(can_delete):
-        # We'll only draw polygons from the must_keep areas at first.
-        keep_polys = []
-        for other_area in cleaned_polygons:
-            for poly in other_area:
-                keep_polys.append(poly)
-        not_contained = []
-        for poly in this_area:
-            if not any([poly.within(other_poly) for other_poly in other_polys]):
-                not_contained.append(poly)
-        first_pass_kept.append(not_contained)
+    # As in earlier versions, the must-keep polygons compared against are the
+    # unmodified ones from every area but the last.
+    delete_polys, delete_area_ids = flatten_parts(can_delete)
+    if len(must_keep) > 0:
+        last_area_id = len(must_keep) - 1
+        other_polys = keep_polys[keep_area_ids != last_area_id]
+    else:
+        other_polys = np.array([], dtype=object)
+    within_keep = np.zeros(len(delete_polys), dtype=bool)
+    if len(other_polys) > 0 and len(delete_polys) > 0:
+        poly_idx, _ = STRtree(other_polys).query(delete_polys, predicate="within")
+        within_keep[poly_idx] = True
+    first_pass_polys = delete_polys[~within_keep]
+    first_pass_area_ids = delete_area_ids[~within_keep]
 
     # Second, deleting any which are contained in another candidate area.
-    for i, this_area in tqdm(enumerate(first_pass_kept), total = len(first_pass_kept)):
-        other_polys = [] # We'll only draw polygons from the must_keep areas at first.
-        for other_area in first_pass_kept:
-            if other_area is not this_area:
-                for poly in other_area:
-                    other_polys.append(poly)
-        not_contained = []
-        for poly in this_area:
-            if not any([poly.within(other_poly) for other_poly in other_polys]):
-                not_contained.append(poly)
-        cleaned_polygons[i].extend(not_contained)
+    within_others = find_within_other_areas(
+        first_pass_polys, first_pass_area_ids, STRtree(first_pass_polys), first_pass_area_ids
+    )
+    for poly, area_id, within in zip(first_pass_polys, first_pass_area_ids, within_others):
+        if not within:
+            cleaned_polygons[area_id].append(poly)
 
     new_admin_areas = [MultiPolygon(area) for area in cleaned_polygons] 
     return new_admin_areas
 
 
-def create_delete_eligibility_mask(polys):
+def fill_holes(admin_polygons):
+    filled_polygons = []
+    for admin_polygon in admin_polygons:
+        filled_poly = [
+            Polygon(poly.exterior) for poly in admin_polygon.geoms
+        ]
+        filled_polygons.append(MultiPolygon(filled_poly))
+    return filled_polygons
+
+
+def flatten_parts(admin_areas):
+    """
+    Flattens the parts of each admin area into one array, alongside an array of the
+    index of the area each part came from.
+    """
+    polys = []
+    area_ids = []
+    for area_id, admin_area in enumerate(admin_areas):
+        parts = admin_area.geoms if hasattr(admin_area, "geoms") else admin_area
+        for poly in parts:
+            polys.append(poly)
+            area_ids.append(area_id)
+    return np.array(polys, dtype=object), np.array(area_ids, dtype=np.int64)
+
+
+def find_within_other_areas(polys, area_ids, tree, tree_area_ids):
+    """
+    Returns a mask of the polygons that lie within a polygon in the tree belonging
+    to a different admin area.
+    """
+    within = np.zeros(len(polys), dtype=bool)
+    if len(polys) == 0 or len(tree.geometries) == 0:
+        return within
+    poly_idx, tree_idx = tree.query(polys, predicate="within")
+    other_area = area_ids[poly_idx] != tree_area_ids[tree_idx]
+    within[poly_idx[other_area]] = True
+    return within
+
+
+def create_delete_eligibility_mask(polys, geodesic=False):
     if len(polys) == 1:
         return [False]
-    areas = [poly.area for poly in polys]
+    areas = geodesic_areas(polys) if geodesic else shapely.area(polys)
     sorted_areas = np.sort(areas)
     area_diffs = np.diff(sorted_areas)
     max_diff = np.argmax(area_diffs)
@@ -232,11 +614,11 @@ def create_delete_eligibility_mask(polys):
     return np.less_equal(areas, max_delete)
 
 
-def separate_deletion_candidates(admin_polygon):
-    if len(admin_polygon) == 0:
+def separate_deletion_candidates(admin_polygon, geodesic=False):
+    if len(admin_polygon.geoms) == 0:
         return ([], [])
-    admin_polygon = np.array(admin_polygon)
-    mask = create_delete_eligibility_mask(admin_polygon)
+    admin_polygon = np.array(list(admin_polygon.geoms), dtype=object)
+    mask = create_delete_eligibility_mask(admin_polygon, geodesic)
     must_keep = admin_polygon[np.invert(mask)]
     can_delete = admin_polygon[mask]
-    return must_keep, can_delete
\ No newline at end of file
+    return must_keep, can_delete
@@ -0,0 +1,490 @@
+import argparse
+import gzip
+import json
+import pickle
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+from . import load, process
+
+try:
+    import pyarrow.compute
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+
+"""
+This module assigns coordinates to the Voronoms admin areas they fall in, for
+every admin level at once, and serves lookups over HTTP.
+"""
+
+
+# The number of grid cells along the longer side of an index's bounds, and of the
+# coarse grid it's built up from.
+DEFAULT_GRID_SIZE = 4096
+GRID_START_SIZE = 32
+
+# Values in an index's grid for cells that need the tree, and for cells that touch
+# no polygon.
+BOUNDARY = -1
+OUTSIDE = -2
+
+# The geonameid returned for points outside every admin area.
+NO_AREA = -1
+
+
+class AdminIndex:
+    """
+    A spatial index over the polygons of one admin level. `grid_size` is the number
+    of grid cells along the longer side of their bounds, or 0 for no grid.
+    """
+
+    def __init__(self, geonameids, polygons, grid_size=DEFAULT_GRID_SIZE):
+        polygons = np.asarray(polygons, dtype=object)
+        present = ~shapely.is_missing(polygons)
+        present[present] = ~shapely.is_empty(polygons[present])
+        self.geonameids = np.asarray(geonameids, dtype=np.int64)[present]
+        self.polygons = polygons[present]
+        shapely.prepare(self.polygons)
+        self.tree = shapely.STRtree(self.polygons)
+        self.grid = None
+        if grid_size and len(self.polygons):
+            self.build_grid(grid_size)
+
+    def build_grid(self, grid_size):
+        """
+        Classifies the cells of a grid over the polygons as inside one polygon,
+        outside them all, or on a boundary, where points need the tree.
+        """
+        x0, y0, x1, y1 = shapely.total_bounds(self.polygons)
+        splits = max(int(np.log2(grid_size / GRID_START_SIZE)), 0)
+        coarse_cell_size = (max(x1 - x0, y1 - y0) or 1.0) / GRID_START_SIZE
+        shape = (
+            max(int(np.ceil((y1 - y0) / coarse_cell_size)), 1),
+            max(int(np.ceil((x1 - x0) / coarse_cell_size)), 1),
+        )
+        # Boundaries are tested against cells segment by segment, which is much
+        # cheaper than testing whole rings.
+        coords, ring_indices = shapely.get_coordinates(
+            shapely.get_rings(shapely.get_parts(self.polygons)), return_index=True
+        )
+        same_ring = ring_indices[1:] == ring_indices[:-1]
+        segments = shapely.STRtree(
+            shapely.linestrings(np.stack([coords[:-1][same_ring], coords[1:][same_ring]], axis=1))
+        )
+
+        grid = np.full(shape, OUTSIDE, dtype=np.int32)
+        rows, cols = np.indices(shape).reshape(2, -1)
+        cell_size = coarse_cell_size
+        for split in range(splits + 1):
+            cells = shapely.box(
+                x0 + cols * cell_size,
+                y0 + rows * cell_size,
+                x0 + (cols + 1) * cell_size,
+                y0 + (rows + 1) * cell_size,
+            )
+            on_boundary = np.zeros(len(cells), dtype=bool)
+            on_boundary[segments.query(cells, predicate="intersects")[0]] = True
+
+            # A cell no boundary passes through is inside the same polygons as its
+            # center, and gets the first of them, as `lookup` does.
+            inner = np.flatnonzero(~on_boundary)
+            centers = shapely.points(
+                x0 + (cols[inner] + 0.5) * cell_size, y0 + (rows[inner] + 0.5) * cell_size
+            )
+            center_indices, polygon_indices = self.tree.query(centers, predicate="intersects")
+            first = np.full(len(inner), len(self.polygons), dtype=np.int32)
+            np.minimum.at(first, center_indices, polygon_indices)
+            first[first == len(self.polygons)] = OUTSIDE
+            grid[rows[inner], cols[inner]] = first
+            grid[rows[on_boundary], cols[on_boundary]] = BOUNDARY
+            if split == splits:
+                break
+
+            # Every cell becomes four, and the boundary cells' children are next.
+            grid = grid.repeat(2, axis=0).repeat(2, axis=1)
+            cell_size /= 2
+            rows = (rows[on_boundary] * 2)[:, None] + np.array([0, 0, 1, 1])
+            cols = (cols[on_boundary] * 2)[:, None] + np.array([0, 1, 0, 1])
+            rows, cols = rows.ravel(), cols.ravel()
+
+        self.grid = grid
+        self.cell_size = cell_size
+        self.origin = (x0, y0)
+
+    def lookup(self, x, y):
+        """
+        Returns the geonameid of the first polygon each point is in, or `NO_AREA`.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(len(x), NO_AREA, dtype=np.int64)
+        if not len(self.polygons):
+            return result
+
+        if self.grid is None:
+            remaining = np.arange(len(x))
+        else:
+            col = np.floor((x - self.origin[0]) / self.cell_size)
+            row = np.floor((y - self.origin[1]) / self.cell_size)
+            inside = (col >= 0) & (col < self.grid.shape[1]) & (row >= 0) & (row < self.grid.shape[0])
+            cells = np.full(len(x), OUTSIDE, dtype=np.int32)
+            cells[inside] = self.grid[row[inside].astype(np.intp), col[inside].astype(np.intp)]
+            found = cells >= 0
+            result[found] = self.geonameids[cells[found]]
+            remaining = np.flatnonzero(cells == BOUNDARY)
+
+        if len(remaining):
+            points = shapely.points(x[remaining], y[remaining])
+            point_indices, polygon_indices = self.tree.query(points, predicate="intersects")
+            # Pairs come back ordered by point, so sorting on the polygon within
+            # each point puts the first polygon a point is in first.
+            order = np.lexsort((polygon_indices, point_indices))
+            point_indices, polygon_indices = point_indices[order], polygon_indices[order]
+            first = np.unique(point_indices, return_index=True)[1]
+            result[remaining[point_indices[first]]] = self.geonameids[polygon_indices[first]]
+        return result
+
+
+class ReverseGeocoder:
+    """
+    Finds the admin areas that coordinates fall in, from a dictionary of indexes
+    keyed by admin level.
+    """
+
+    def __init__(self, indexes):
+        self.indexes = dict(sorted(indexes.items()))
+
+    @classmethod
+    def from_polygons(cls, admin_polygons, grid_size=DEFAULT_GRID_SIZE):
+        """
+        Builds a geocoder from a dictionary of (geonameids, polygons) by admin level.
+        """
+        return cls({
+            admin_level: AdminIndex(geonameids, polygons, grid_size)
+            for admin_level, (geonameids, polygons) in admin_polygons.items()
+        })
+
+    @classmethod
+    def from_geoparquet(cls, filename, countries=None, admin_levels=None, lod=0, grid_size=DEFAULT_GRID_SIZE):
+        """
+        Builds a geocoder from the polygons in a GeoParquet file written by
+        `generate_voronoms.py`, for all countries and admin levels by default.
+        """
+        if parquet is None:
+            raise ImportError("Reading GeoParquet requires pyarrow.")
+        filters = [("lod", "=", lod)]
+        if countries is not None:
+            filters.append(("country", "in", list(countries)))
+        if admin_levels is not None:
+            filters.append(("level", "in", list(admin_levels)))
+        table = parquet.read_table(filename, columns=["level", "geonameid", "geometry"], filters=filters)
+
+        admin_polygons = {}
+        levels = table.column("level").to_numpy()
+        for admin_level in np.unique(levels):
+            rows = table.filter(pyarrow.compute.equal(table.column("level"), admin_level))
+            admin_polygons[int(admin_level)] = (
+                rows.column("geonameid").to_numpy(),
+                shapely.from_wkb(rows.column("geometry").to_numpy()),
+            )
+        return cls.from_polygons(admin_polygons, grid_size)
+
+    @classmethod
+    def from_geojson(cls, directory, countries, admin_levels=(1, 2, 3), grid_size=DEFAULT_GRID_SIZE):
+        """
+        Builds a geocoder from the GeoJSON files `generate_voronoms.py` writes.
+        """
+        admin_polygons = {}
+        for admin_level in admin_levels:
+            geonameids = []
+            polygons = []
+            for country in countries:
+                for filename in [
+                    Path(directory, "{}-{}.json".format(country, admin_level)),
+                    Path(directory, "{}-{}.json.gz".format(country, admin_level)),
+                ]:
+                    if filename.exists():
+                        opener = gzip.open if filename.suffix == ".gz" else open
+                        with opener(filename, "rt", encoding="utf-8") as f:
+                            features = json.load(f)["features"]
+                        geonameids.extend(feature["properties"]["geoNameId"] for feature in features)
+                        polygons.extend(
+                            shapely.geometry.shape(feature["geometry"]) if feature["geometry"] else None
+                            for feature in features
+                        )
+                        break
+            if geonameids:
+                admin_polygons[admin_level] = (geonameids, polygons)
+        return cls.from_polygons(admin_polygons, grid_size)
+
+    @classmethod
+    def from_geonames(cls, countries, geonames, shapes, admin_levels=(1, 2, 3)):
+        """
+        Builds a geocoder with a `NearestIndex` for each admin level, without
+        making any polygons.
+        """
+        indexes = {}
+        for admin_level in admin_levels:
+            index = NearestIndex.from_geonames(countries, admin_level, geonames, shapes)
+            if index.countries:
+                indexes[admin_level] = index
+        return cls(indexes)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def lookup(self, latitude, longitude):
+        """
+        Returns a DataFrame with a column of geonameids for each admin level.
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        if latitude.shape != longitude.shape:
+            raise ValueError("Latitudes and longitudes must have the same shape.")
+        return pd.DataFrame({
+            "admin{}".format(admin_level): index.lookup(longitude.ravel(), latitude.ravel())
+            for admin_level, index in self.indexes.items()
+        })
+
+
+# Nearest-point lookups
+#
+# A `NearestIndex` keeps a KD-tree over each country's Voronoi GeoNames for an
+# admin level, labeled with the geonameid of the admin area each one belongs to.
+# A coordinate takes the label of its nearest point in the country, as long as
+# it's inside the country's outline.
+#
+# The outline only has to be tested near its boundary. If a point inside the
+# outline is nearer to the coordinate than to the outline's boundary, the
+# coordinate is inside the outline too, and likewise for a point outside it. So
+# each point's distance to the boundary is kept, and only coordinates further
+# from their nearest point than that are tested against the outline.
+#
+# The answers are those of the raw tessellation. They can differ from the
+# polygons where the polygons were cleaned, and at the edge of the country, where
+# the tessellation's unbounded cells are left out of the polygons.
+
+
+class CountrySites:
+    """
+    The Voronoi GeoNames of one country at one admin level, as a KD-tree.
+    """
+
+    def __init__(self, coordinates, labels, outline):
+        self.tree = cKDTree(coordinates)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.outline = outline
+        self.bounds = outline.bounds
+        shapely.prepare(outline)
+        self.inside = shapely.intersects_xy(outline, coordinates[:, 0], coordinates[:, 1])
+        self.clearance = shapely.distance(
+            shapely.boundary(outline), shapely.points(coordinates)
+        )
+
+    def lookup(self, x, y):
+        """
+        Returns the label of each point's nearest GeoNames point and whether each
+        point is inside the outline.
+        """
+        distances, nearest = self.tree.query(np.column_stack([x, y]))
+        inside = self.inside[nearest]
+        unsure = distances >= self.clearance[nearest]
+        if unsure.any():
+            # Prepared geometries aren't pickled, so a loaded outline is prepared here.
+            shapely.prepare(self.outline)
+            inside[unsure] = shapely.intersects_xy(self.outline, x[unsure], y[unsure])
+        return np.where(inside, self.labels[nearest], NO_AREA), inside
+
+
+class NearestIndex:
+    """
+    Answers lookups at one admin level from the nearest Voronoi GeoNames point,
+    given a dictionary of `CountrySites` keyed by country code.
+    """
+
+    def __init__(self, countries):
+        self.countries = countries
+
+    @classmethod
+    def from_geonames(cls, countries, admin_level, geonames, shapes):
+        """
+        Builds an index over each country's Voronoi GeoNames for the admin level.
+        """
+        sites = {}
+        for country in countries:
+            country_geonames = process.get_country_geonames(country, geonames)
+            admin_geonames = process.get_admin_geonames(country, admin_level, country_geonames)
+            voronoi_geonames = process.get_voronoi_geonames(
+                country, admin_level, country_geonames, admin_geonames
+            )
+            if len(voronoi_geonames) == 0:
+                continue
+            point_index = process.index_voronoi_points(admin_level, voronoi_geonames)
+            labels = np.full(len(voronoi_geonames), NO_AREA, dtype=np.int64)
+            # In reverse, so that a point claimed by more than one area goes to the
+            # first, as it does when looking up polygons.
+            for geonameid, admin_geoname in reversed(list(admin_geonames.iterrows())):
+                point_indices = process.get_admin_point_indices(
+                    admin_geoname, admin_level, point_index, voronoi_geonames
+                )
+                labels[point_indices] = geonameid
+            outline = process.get_country_outline(country, country_geonames, shapes)
+            sites[country] = CountrySites(process.get_coordinates(voronoi_geonames), labels, outline)
+        return cls(sites)
+
+    def lookup(self, x, y):
+        """
+        Returns the geonameid of the admin area each point is in, or `NO_AREA`.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(len(x), NO_AREA, dtype=np.int64)
+        remaining = np.ones(len(x), dtype=bool)
+        for sites in self.countries.values():
+            x0, y0, x1, y1 = sites.bounds
+            candidates = np.flatnonzero(remaining & (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+            if not len(candidates):
+                continue
+            labels, inside = sites.lookup(x[candidates], y[candidates])
+            result[candidates] = np.where(inside, labels, result[candidates])
+            remaining[candidates[inside]] = False
+        return result
+
+
+def benchmark(geocoders, latitude, longitude):
+    """
+    Times a dictionary of geocoders on the same coordinates, and compares their
+    answers with those of the first.
+    """
+    x = np.asarray(longitude, dtype=np.float64)
+    y = np.asarray(latitude, dtype=np.float64)
+    rows = []
+    reference = {}
+    for name, geocoder in geocoders.items():
+        for admin_level, index in geocoder.indexes.items():
+            start = time.perf_counter()
+            result = index.lookup(x, y)
+            elapsed = time.perf_counter() - start
+            reference.setdefault(admin_level, result)
+            agreement = np.mean(result == reference[admin_level])
+            rows.append({
+                "geocoder": name,
+                "admin_level": admin_level,
+                "points_per_second": len(result) / elapsed if elapsed > 0 else np.inf,
+                "agreement": agreement,
+            })
+    return pd.DataFrame(rows)
+
+
+# HTTP endpoint
+#
+# `serve` answers POST requests to /lookup whose body is a JSON object with
+# "latitude" and "longitude" arrays, with a JSON object holding an array of
+# geonameids for each admin level. GET requests to /lookup take a single point as
+# the "lat" and "lon" query parameters. The server is meant to run locally, next
+# to the code that needs it.
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    geocoder = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/lookup":
+            return self.send_json(404, {"error": "Not found."})
+        query = parse_qs(url.query)
+        try:
+            latitude = [float(query["lat"][0])]
+            longitude = [float(query["lon"][0])]
+        except (KeyError, ValueError):
+            return self.send_json(400, {"error": "Expected numeric 'lat' and 'lon' parameters."})
+        self.send_lookup(latitude, longitude, single=True)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/lookup":
+            return self.send_json(404, {"error": "Not found."})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            latitude = np.asarray(body["latitude"], dtype=np.float64)
+            longitude = np.asarray(body["longitude"], dtype=np.float64)
+        except (KeyError, TypeError, ValueError):
+            return self.send_json(400, {"error": "Expected 'latitude' and 'longitude' arrays."})
+        self.send_lookup(latitude, longitude)
+
+    def send_lookup(self, latitude, longitude, single=False):
+        try:
+            result = self.geocoder.lookup(latitude, longitude)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        if single:
+            self.send_json(200, {col: int(result[col].iloc[0]) for col in result.columns})
+        else:
+            self.send_json(200, {col: result[col].tolist() for col in result.columns})
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(geocoder, host="127.0.0.1", port=8000):
+    """
+    Answers lookups with a geocoder over HTTP until interrupted.
+    """
+    handler = type("GeocoderLookupHandler", (LookupHandler,), {"geocoder": geocoder})
+    server = ThreadingHTTPServer((host, port), handler)
+    print("Serving lookups on http://{}:{}/lookup.".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parquet", type=str, default="export/voronoms.parquet")
+    parser.add_argument("--countries", "-c", type=str, nargs="*")
+    parser.add_argument("--admin-levels", "-a", type=int, nargs="*")
+    parser.add_argument("--lod", type=int, default=0)
+    parser.add_argument("--grid-size", type=int, default=DEFAULT_GRID_SIZE)
+    parser.add_argument("--nearest", action="store_true")
+    parser.add_argument("--index", type=str)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.index and Path(args.index).exists():
+        geocoder = ReverseGeocoder.load(args.index)
+    elif args.nearest:
+        geonames = load.geonames_by_country(
+            load.geonames(columns=load.PROCESSING_COLUMNS, countries=args.countries, compact=True)
+        )
+        geocoder = ReverseGeocoder.from_geonames(
+            args.countries or list(geonames.keys()), geonames, load.shapes(), args.admin_levels or (1, 2, 3)
+        )
+    else:
+        geocoder = ReverseGeocoder.from_geoparquet(
+            args.parquet, args.countries, args.admin_levels, args.lod, args.grid_size
+        )
+    if args.index and not Path(args.index).exists():
+        geocoder.save(args.index)
+    serve(geocoder, args.host, args.port)
@@ -1,17 +1,62 @@
+import numpy as np
 import pyproj
-from shapely.ops import transform
-from functools import partial
+import shapely
+
+
+"""
+This module measures Voronoms polygons on the WGS84 ellipsoid.
+"""
+
+
+GEOD = pyproj.Geod(ellps="WGS84")
+
+
+def geodesic_area_perimeter(polygons):
+    """
+    Returns the geodesic areas in square meters and perimeters in meters of a
+    list of polygons, as two arrays.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    areas = np.zeros(len(polygons))
+    perimeters = np.zeros(len(polygons))
+    present = ~shapely.is_missing(polygons)
+    if not present.any():
+        return areas, perimeters
+
+    parts, part_index = shapely.get_parts(polygons[present], return_index=True)
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    coordinates, vertex_index = shapely.get_coordinates(rings, return_index=True)
+    starts = np.searchsorted(vertex_index, np.arange(len(rings) + 1))
+
+    ring_areas = np.empty(len(rings))
+    ring_perimeters = np.empty(len(rings))
+    lons, lats = coordinates[:, 0], coordinates[:, 1]
+    for i, (start, end) in enumerate(zip(starts[:-1], starts[1:])):
+        # The closing point repeats the first, which `polygon_area_perimeter`
+        # doesn't need.
+        ring_areas[i], ring_perimeters[i] = GEOD.polygon_area_perimeter(
+            lons[start:end - 1], lats[start:end - 1]
+        )
+
+    # Each part's exterior comes first, and its holes are subtracted from it
+    # whichever way they run.
+    is_exterior = np.r_[True, ring_index[1:] != ring_index[:-1]]
+    ring_areas = np.where(is_exterior, 1, -1) * np.abs(ring_areas)
+    polygon_of_ring = np.flatnonzero(present)[part_index[ring_index]]
+    np.add.at(areas, polygon_of_ring, ring_areas)
+    np.add.at(perimeters, polygon_of_ring, ring_perimeters)
+    return areas, perimeters
+
+
+def geodesic_areas(polygons):
+    """
+    Returns the geodesic areas of a list of polygons, in square meters.
+    """
+    return geodesic_area_perimeter(polygons)[0]
 
 
 def calculate_area(poly):
-    geom_area = transform(
-        partial(
-            pyproj.transform,
-            pyproj.Proj(init='EPSG:4326'),
-            pyproj.Proj(
-                proj='aea',
-                lat_1=poly.bounds[1],
-                lat_2=poly.bounds[3])),
-            poly)
-
-    return geom_area.area / 1000000
\ No newline at end of file
+    """
+    Returns the geodesic area of a polygon in square kilometers.
+    """
+    return geodesic_areas([poly])[0] / 1000000.
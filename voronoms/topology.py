@@ -0,0 +1,280 @@
+import numpy as np
+import shapely
+
+
+"""
+This module builds TopoJSON topologies from Voronoms polygons, and simplifies
+them along their shared boundaries into levels of detail.
+"""
+
+
+DEFAULT_QUANTIZATION = 100000
+
+
+def topology(polygons, properties=None, name="polygons", quantization=DEFAULT_QUANTIZATION):
+    """
+    Builds a TopoJSON topology from a list of polygons, as a dictionary.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    bbox, transform = quantization_transform(polygons, quantization)
+    polygon_arcs, arcs = shared_arcs(polygons, transform)
+
+    geometries = []
+    for i, (polygon, parts) in enumerate(zip(polygons, polygon_arcs)):
+        if not parts:
+            geometry = {"type": None}
+        elif shapely.get_type_id(polygon) == 3:
+            geometry = {"type": "Polygon", "arcs": parts[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "arcs": parts}
+        if properties is not None:
+            geometry["properties"] = properties[i]
+        geometries.append(geometry)
+
+    return {
+        "type": "Topology",
+        "bbox": bbox,
+        "transform": {"scale": transform[1], "translate": transform[0]},
+        "objects": {name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [delta_encode(arc) for arc in arcs],
+    }
+
+
+def quantization_transform(polygons, quantization):
+    """
+    Returns the polygons' bounding box and the transform that quantizes it.
+    """
+    present = ~shapely.is_missing(polygons)
+    present[present] = ~shapely.is_empty(polygons[present])
+    if present.any():
+        x0, y0, x1, y1 = shapely.total_bounds(polygons[present]).tolist()
+    else:
+        x0 = y0 = x1 = y1 = 0.0
+    scale = [
+        (x1 - x0) / (quantization - 1) if x1 > x0 else 1.0,
+        (y1 - y0) / (quantization - 1) if y1 > y0 else 1.0,
+    ]
+    return [x0, y0, x1, y1], ([x0, y0], scale)
+
+
+def shared_arcs(polygons, transform=None):
+    """
+    Breaks polygons into the arcs of their shared boundaries, quantized if a
+    transform is given, and returns each polygon's arc references and the arcs.
+    """
+    rings_by_polygon = [
+        polygon_rings(polygon, transform) if polygon is not None else []
+        for polygon in polygons
+    ]
+    all_rings = [ring for parts in rings_by_polygon for rings in parts for ring in rings]
+    junctions = find_junctions(all_rings)
+    arcs = ArcIndex()
+    polygon_arcs = [
+        [[arcs.add_ring(ring, junctions) for ring in rings] for rings in parts]
+        for parts in rings_by_polygon
+    ]
+    return polygon_arcs, arcs.arcs
+
+
+def polygon_rings(polygon, transform=None):
+    """
+    Returns a polygon's open rings, grouped by part, as lists of points.
+    """
+    parts = []
+    for part in shapely.get_parts(polygon):
+        if shapely.get_type_id(part) != 3 or part.is_empty:
+            continue
+        rings = []
+        for ring in [part.exterior] + list(part.interiors):
+            coords = shapely.get_coordinates(ring)
+            if transform is not None:
+                (x0, y0), (kx, ky) = transform
+                quantized = np.empty(coords.shape, dtype=np.int64)
+                quantized[:, 0] = np.round((coords[:, 0] - x0) / kx)
+                quantized[:, 1] = np.round((coords[:, 1] - y0) / ky)
+                coords = quantized
+            keep = np.ones(len(coords), dtype=bool)
+            keep[1:] = (coords[1:] != coords[:-1]).any(axis=1)
+            points = [tuple(point) for point in coords[keep].tolist()]
+            if len(points) > 1 and points[0] == points[-1]:
+                points.pop()
+            if len(points) >= 3:
+                rings.append(points)
+            elif not rings:
+                # The exterior collapsed, so the whole part goes.
+                break
+        if rings:
+            parts.append(rings)
+    return parts
+
+
+def find_junctions(rings):
+    """
+    Returns the points whose neighbors differ between the rings they're in.
+    """
+    neighbors = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            previous, following = ring[i - 1], ring[(i + 1) % n]
+            seen = neighbors.get(point)
+            if seen is None:
+                neighbors[point] = (previous, following)
+            elif seen != (previous, following) and seen != (following, previous):
+                junctions.add(point)
+    return junctions
+
+
+class ArcIndex:
+    """
+    The distinct arcs of a topology, each stored once.
+    """
+
+    def __init__(self):
+        self.arcs = []
+        self.index = {}
+
+    def add_ring(self, ring, junctions):
+        """
+        Cuts a ring into arcs at its junctions and returns their references.
+        """
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            ring = canonical_ring(ring)
+            return [self.add_arc(ring + [ring[0]], closed=True)]
+        # Start the ring at its first junction, so that every arc runs from one
+        # junction to the next.
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+        ring = ring + [ring[0]]
+        return [self.add_arc(ring[a:b + 1]) for a, b in zip(cuts[:-1], cuts[1:])]
+
+    def add_arc(self, arc, closed=False):
+        key = tuple(arc)
+        if key in self.index:
+            return self.index[key]
+        # A ring that runs along an arc backwards refers to it by the one's
+        # complement of its index.
+        reverse = key[::-1]
+        if closed:
+            # Closed arcs start at their smallest point, whichever way they run.
+            reverse = canonical_ring(list(reverse[:-1]))
+            reverse = tuple(reverse + [reverse[0]])
+        if reverse in self.index:
+            return ~self.index[reverse]
+        self.index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return self.index[key]
+
+
+def canonical_ring(ring):
+    """
+    Rotates an open ring to start at its smallest point.
+    """
+    start = ring.index(min(ring))
+    return ring[start:] + ring[:start]
+
+
+def delta_encode(arc):
+    arc = np.asarray(arc, dtype=np.int64)
+    deltas = arc.copy()
+    deltas[1:] = arc[1:] - arc[:-1]
+    return deltas.tolist()
+
+
+# Levels of detail
+#
+# Each level is made by simplifying the arcs the polygons share, so neighbors are
+# simplified the same way along their common boundaries.
+
+
+def simplification_pyramid(polygons, tolerances):
+    """
+    Simplifies polygons at a series of tolerances, returning a dictionary of lists
+    of polygons keyed by level of detail, with the polygons themselves at level 0.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    polygon_arcs, arcs = shared_arcs(polygons)
+    lengths = [len(arc) for arc in arcs]
+    lines = shapely.linestrings(
+        np.concatenate(arcs) if arcs else np.empty((0, 2)),
+        indices=np.repeat(np.arange(len(arcs)), lengths),
+    )
+
+    pyramid = {0: list(polygons)}
+    for level, tolerance in enumerate(tolerances, 1):
+        pyramid[level] = simplify_arcs(polygons, polygon_arcs, lines, tolerance)
+    return pyramid
+
+
+def simplify_arcs(polygons, polygon_arcs, lines, tolerance):
+    """
+    Simplifies each arc on its own and rebuilds the polygons from them.
+    """
+    tolerances = np.full(len(lines), float(tolerance))
+    while True:
+        simplified = shapely.simplify(lines, tolerances, preserve_topology=True)
+        coords, index = shapely.get_coordinates(simplified, return_index=True)
+        arcs = np.split(coords, np.searchsorted(index, np.arange(1, len(lines))))
+        rebuilt = [
+            assemble_polygon(polygon, parts, arcs)
+            for polygon, parts in zip(polygons, polygon_arcs)
+        ]
+
+        # Arcs that cross another, or make a ring cross itself, are simplified
+        # again at half the tolerance, and after a few halvings left alone.
+        conflicts = ~shapely.is_simple(simplified)
+        tree = shapely.STRtree(simplified)
+        for predicate in ("crosses", "overlaps"):
+            pairs = tree.query(simplified, predicate=predicate)
+            conflicts[pairs.ravel()] = True
+        for parts, polygon in zip(polygon_arcs, rebuilt):
+            if not polygon.is_valid:
+                references = np.array([r for rings in parts for ring in rings for r in ring])
+                conflicts[np.where(references >= 0, references, ~references)] = True
+
+        conflicts &= tolerances > 0
+        if not conflicts.any():
+            return rebuilt
+        tolerances[conflicts] /= 2
+        tolerances[tolerances < tolerance / 16] = 0
+
+
+def assemble_polygon(polygon, parts, arcs):
+    """
+    Rebuilds a polygon from its parts' arc references, dropping collapsed rings.
+    """
+    rebuilt = []
+    for rings in parts:
+        coords = [ring_coordinates(ring, arcs) for ring in rings]
+        if is_ring(coords[0]):
+            rebuilt.append(shapely.Polygon(coords[0], [ring for ring in coords[1:] if is_ring(ring)]))
+    if polygon is not None and shapely.get_type_id(polygon) == 3:
+        return rebuilt[0] if rebuilt else shapely.Polygon()
+    return shapely.MultiPolygon(rebuilt)
+
+
+def ring_coordinates(ring, arcs):
+    pieces = []
+    for i, reference in enumerate(ring):
+        arc = arcs[reference] if reference >= 0 else arcs[~reference][::-1]
+        pieces.append(arc if i == 0 else arc[1:])
+    return np.concatenate(pieces)
+
+
+def is_ring(coords):
+    # Whether a closed ring still has an area, by the shoelace formula.
+    x, y = coords[:, 0], coords[:, 1]
+    return len(coords) >= 4 and np.dot(x[:-1], y[1:]) != np.dot(x[1:], y[:-1])
+
+
+def select_lod(polygons, lod=None):
+    """
+    Returns the polygons at a level of detail from a simplification pyramid.
+    """
+    if isinstance(polygons, dict):
+        return polygons[lod or 0]
+    if lod:
+        raise ValueError("Level of detail {} requested from polygons without a pyramid.".format(lod))
+    return polygons
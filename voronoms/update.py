@@ -0,0 +1,224 @@
+import json
+import os
+from datetime import date, datetime, timedelta
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from . import load
+from .cache import CACHE_DIR, cached_path, write_cached
+from .download import geonames_file, read_validators
+
+
+"""
+This module patches the cached GeoNames table with GeoNames's daily modifications
+and deletes files, and records which countries they've changed.
+"""
+
+
+DELTA_RECORD_PATH = Path(CACHE_DIR, "geonames_deltas.json")
+
+# Columns that `load.prepare_geonames` derives, which are rebuilt after patching.
+DERIVED_COLUMNS = ["admin{}_key".format(level) for level in load.ADMIN_LEVELS] + [
+    "points",
+    "admin5_code",
+]
+
+
+def update_geonames(dates=None, **geonames_kwargs):
+    """
+    Applies GeoNames's daily deltas for `dates`, or for the pending dates, to the
+    cached table `load.geonames(**geonames_kwargs)` returns. Returns the patched
+    table and the set of countries whose GeoNames changed.
+    """
+    key = load.geonames.cache_key(**geonames_kwargs)
+    geonames = load.geonames(**geonames_kwargs)
+    record = read_delta_record(key)
+    if dates is None:
+        dates = pending_dates(record)
+
+    deltas = []
+    for day in dates:
+        day = str(day)
+        try:
+            modifications_path = geonames_file("modifications-{}.txt".format(day))
+            deletes_path = geonames_file("deletes-{}.txt".format(day))
+        except FileNotFoundError:
+            print("GeoNames deltas for {} aren't available; skipping.".format(day))
+            continue
+        deltas.append((day, modifications_path, deletes_path))
+    if not deltas:
+        return geonames, set()
+
+    geonames, touched_by_day = apply_deltas(geonames, deltas, geonames_kwargs)
+    touched = set()
+    for day, day_touched in touched_by_day.items():
+        print("Applied GeoNames deltas for {}, touching {} countries.".format(day, len(day_touched)))
+        if day not in record["applied"]:
+            record["applied"].append(day)
+        for country in day_touched:
+            record["countries"][country] = max(day, record["countries"].get(country, ""))
+        touched |= day_touched
+
+    write_cached(load.geonames.cache_name, key, geonames)
+    write_delta_record(record)
+    print("Saved updated 'geonames' to cache.")
+    return geonames, touched
+
+
+def apply_deltas(geonames, deltas, geonames_kwargs):
+    """
+    Patches a GeoNames table with a list of (date, modifications path, deletes
+    path) deltas, and returns it with the countries each day changed.
+    """
+    columns = geonames_kwargs.get("columns")
+    countries = geonames_kwargs.get("countries")
+    feature_classes = geonames_kwargs.get("feature_classes")
+
+    # The country code is always read, to know which countries are touched.
+    read_columns = None if columns is None else list(columns) + ["country_code"]
+    existing_countries = geonames.country_code if "country_code" in geonames.columns else None
+
+    # The days are folded together first, so that a row takes its latest version,
+    # and the table is patched once.
+    modifications = None
+    replaced_ids = pd.Index([], dtype=np.int64)
+    touched_by_day = {}
+    for day, modifications_path, deletes_path in deltas:
+        day_modifications = read_modifications(modifications_path, read_columns)
+        day_deleted_ids = pd.Index(read_deleted_ids(deletes_path))
+        changed_ids = day_modifications.index.union(day_deleted_ids)
+
+        touched = set()
+        if existing_countries is not None:
+            removed_ids = geonames.index.intersection(changed_ids)
+            touched |= set(existing_countries.loc[removed_ids].dropna().astype(str))
+        if modifications is not None:
+            touched |= set(modifications.country_code.loc[
+                modifications.index.intersection(changed_ids)
+            ].dropna().astype(str))
+            modifications = modifications.drop(index=modifications.index.intersection(changed_ids))
+
+        if countries is not None:
+            day_modifications = day_modifications[day_modifications.country_code.isin(countries)]
+        if feature_classes is not None:
+            day_modifications = day_modifications[day_modifications.feature_class.isin(feature_classes)]
+        touched |= set(day_modifications.country_code.dropna().astype(str))
+        touched_by_day[day] = touched
+
+        modifications = day_modifications if modifications is None else pd.concat(
+            [modifications, day_modifications]
+        )
+        replaced_ids = replaced_ids.union(changed_ids)
+
+    if columns is not None and "country_code" not in columns:
+        modifications = modifications.drop(columns=["country_code"])
+
+    # Derived columns and dtypes are rebuilt over the whole table, so that they
+    # come out as they would from loading the patched file from scratch.
+    base = geonames.drop(columns=[col for col in DERIVED_COLUMNS if col in geonames.columns])
+    base = base.drop(index=geonames.index.intersection(replaced_ids))
+    for col in base.columns:
+        if isinstance(base[col].dtype, pd.CategoricalDtype):
+            base[col] = base[col].astype(object)
+    patched = pd.concat([base, modifications[base.columns]]).sort_index()
+    patched = load.prepare_geonames(
+        patched,
+        include_points=geonames_kwargs.get("include_points", False),
+        include_admin5=geonames_kwargs.get("include_admin5", False),
+        compact=geonames_kwargs.get("compact", False),
+        float32=geonames_kwargs.get("float32", False),
+    )
+    return patched, touched_by_day
+
+
+def read_modifications(modifications_path, columns=None):
+    if Path(modifications_path).stat().st_size == 0:
+        read_columns = load.GEONAMES_COLUMNS[1:] if columns is None else columns
+        return pd.DataFrame(
+            {col: pd.Series(dtype=load.GEONAMES_COLUMN_TYPES[col]) for col in read_columns},
+            index=pd.Index([], dtype=np.int64, name="geonameid"),
+        )
+    return load.read_geonames_table(modifications_path, columns=columns)
+
+
+def read_deleted_ids(deletes_path):
+    if Path(deletes_path).stat().st_size == 0:
+        return np.array([], dtype=np.int64)
+    deletes = pd.read_table(
+        deletes_path,
+        names=["geonameid", "name", "comment"],
+        dtype={"geonameid": np.int64},
+        usecols=["geonameid"],
+    )
+    return deletes.geonameid.to_numpy()
+
+
+def pending_dates(record):
+    """
+    Returns the dates whose deltas haven't been applied to the table, up to yesterday.
+    """
+    if record["applied"]:
+        start = date.fromisoformat(max(record["applied"])) + timedelta(days=1)
+    else:
+        # The dump may have been made partway through the day before, and
+        # applying a day's deltas twice does no harm.
+        start = dump_date() - timedelta(days=1)
+    yesterday = date.today() - timedelta(days=1)
+    return [start + timedelta(days=n) for n in range((yesterday - start).days + 1)]
+
+
+def dump_date():
+    """
+    Returns the date of the allCountries.txt dump.
+    """
+    last_modified = read_validators("allCountries.txt").get("last_modified")
+    if last_modified:
+        return parsedate_to_datetime(last_modified).date()
+    modified = geonames_file("allCountries.txt").stat().st_mtime
+    return datetime.fromtimestamp(modified).date()
+
+
+def read_delta_records():
+    """
+    Returns the delta records of every cache entry, keyed by the entry's key.
+    """
+    if not DELTA_RECORD_PATH.exists():
+        return {}
+    with open(DELTA_RECORD_PATH) as f:
+        records = json.load(f)
+    if "key" in records:
+        # Older versions kept the record of a single entry.
+        records = {records["key"]: records}
+    return records
+
+
+def read_delta_record(key):
+    """
+    Returns the delta record for a cache entry's key.
+    """
+    return read_delta_records().get(key, {"key": key, "applied": [], "countries": {}})
+
+
+def write_delta_record(record):
+    """
+    Saves a cache entry's delta record, dropping those of entries no longer cached.
+    """
+    records = {
+        key: other for key, other in read_delta_records().items()
+        if cached_path(load.geonames.cache_name, key) is not None
+    }
+    records[record["key"]] = record
+    temp_path = DELTA_RECORD_PATH.with_name(DELTA_RECORD_PATH.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+    os.replace(temp_path, DELTA_RECORD_PATH)
+
+
+def dirty_countries(**geonames_kwargs):
+    """
+    Returns the countries deltas have changed, mapped to the latest such date.
+    """
+    if not DELTA_RECORD_PATH.exists():
+        return {}
+    return read_delta_record(load.geonames.cache_key(**geonames_kwargs))["countries"]